@@ -0,0 +1,230 @@
+import frappe
+from frappe.utils import cint, flt
+
+from hksoho.byrydens.transport_order_api import (
+    get_product_dimensions,
+    get_shippable_po_items,
+    parse_po_names,
+)
+
+# 各櫃型可用裝載上限（已扣除實際裝櫃損耗，非理論容積）
+CONTAINER_LIMITS = {
+    "20FT Container": {"cbm": 28.0, "gross_kg": 21700.0},
+    "20GP Container": {"cbm": 28.0, "gross_kg": 21700.0},
+    "40FT Container": {"cbm": 58.0, "gross_kg": 26500.0},
+    "40GP Container": {"cbm": 58.0, "gross_kg": 26500.0},
+    "40HC Container": {"cbm": 68.0, "gross_kg": 26300.0},
+}
+DEFAULT_EQUIPMENT = "40HC Container"
+
+
+@frappe.whitelist()
+def plan_containers(po_names, equipment=None, to_name=None, apply=False):
+    """
+    Propose container allocations for the remaining shippable lines of the given Purchase Orders.
+
+    Lines are packed first-fit decreasing by volume against the CBM and gross weight limits
+    of the selected equipment. A line that does not fit in one container is split by units.
+
+    Args:
+        po_names (str or list): Purchase Order names (list or JSON list)
+        equipment (str): Container type, one of CONTAINER_LIMITS
+            (default: the Transport Order's equipment, else 40HC)
+        to_name (str): Transport Order to write the proposed allocation into
+        apply (bool): When true, append the allocated lines to `to_name` with their Container #
+    Returns:
+        dict: {"equipment", "containers": [{"container_seq", "cbm", "gross_kg", "ctns", "lines"}],
+               "unplanned": [line, ...]}
+    """
+    po_names = parse_po_names(po_names)
+    if not po_names:
+        frappe.throw("Please provide at least one Purchase Order number")
+
+    if not frappe.has_permission("Purchase Order", "read"):
+        frappe.throw("You do not have sufficient permissions to access Purchase Order items.", frappe.PermissionError)
+
+    to_doc = None
+    exclude_po_lines = set()
+    if to_name:
+        to_doc = frappe.get_doc("Transport Order", to_name)
+        to_doc.check_permission("write" if frappe.utils.sbool(apply) else "read")
+        exclude_po_lines = {str(row.po_line) for row in to_doc.items if row.po_line}
+
+    # 未指定櫃型時以 Transport Order 本身的 equipment 為準，兩者皆無才用 40HC
+    equipment = equipment or (to_doc.equipment if to_doc else None) or DEFAULT_EQUIPMENT
+    if equipment not in CONTAINER_LIMITS:
+        frappe.throw(f"Container planning is not supported for {equipment}. "
+                     f"Choose one of: {', '.join(CONTAINER_LIMITS)}")
+
+    grouped = get_shippable_po_items(po_names)
+    items = [item for po_items in grouped.values() for item in po_items
+             if str(item.name) not in exclude_po_lines]
+    lines = _get_plan_lines(items)
+
+    containers, unplanned = pack_lines(lines, CONTAINER_LIMITS[equipment])
+    result = {"equipment": equipment, "containers": containers, "unplanned": unplanned}
+
+    if to_doc and frappe.utils.sbool(apply):
+        _apply_plan(to_doc, equipment, containers)
+        result["transport_order"] = to_doc.name
+
+    return result
+
+
+def _get_plan_lines(items):
+    """把 PO 明細轉成規劃用的資料：剩餘數量、每 unit 的箱數 / 材積 / 毛重"""
+    dimensions = get_product_dimensions([item.article_number for item in items])
+
+    lines = []
+    for item in items:
+        # ctns 為每個 unit 的箱數，只有 Product 的 number_of_cartons_colli_per_unit 有這項資料；
+        # PO 的 ctns_on_pallet 是每板箱數，不能當作每 unit 箱數，沒有 Product 資料時以 1 unit = 1 箱計
+        product = dimensions.get(item.article_number)
+        if product:
+            ctns = cint(product["ctns"]) or 1
+            cbm = flt(product["cbm"])
+            gross_kg = flt(product["gross_kg"])
+        else:
+            ctns = 1
+            cbm = flt(item.carton_cbm)
+            gross_kg = flt(item.carton_gross_kg)
+
+        lines.append(frappe._dict({
+            "po_number": item.po_number,
+            "po_line": item.name,
+            "line": item.line,
+            "article_number": item.article_number,
+            "article_name": item.article_name,
+            "qty": cint(item.booked_qty) - cint(item.delivery_qty),
+            "ctns": ctns,
+            "cbm": cbm,
+            "gross_kg": gross_kg,
+            "unit_price": flt(item.unit_price),
+            # 每個 unit 的材積與毛重
+            "unit_cbm": ctns * cbm,
+            "unit_kg": ctns * gross_kg,
+        }))
+    return lines
+
+
+def pack_lines(lines, limits):
+    """
+    First-fit decreasing bin packing on volume with a weight constraint.
+
+    Returns (containers, unplanned). Lines whose single unit exceeds the container limits
+    are returned in `unplanned`.
+    """
+    max_cbm, max_kg = limits["cbm"], limits["gross_kg"]
+    containers = []
+    unplanned = []
+    plannable = []
+    for line in lines:
+        if line.qty <= 0:
+            continue
+        if line.unit_cbm > max_cbm or line.unit_kg > max_kg:
+            unplanned.append(line)
+        else:
+            plannable.append(line)
+    if not plannable:
+        return containers, unplanned
+
+    # 剩餘空間小於最小 unit 的貨櫃不可能再放入任何東西，從 open_containers 移除
+    min_cbm = min(line.unit_cbm for line in plannable)
+    min_kg = min(line.unit_kg for line in plannable)
+    open_containers = []
+
+    for line in sorted(plannable, key=lambda l: l.unit_cbm * l.qty, reverse=True):
+        remaining = line.qty
+        for container in open_containers:
+            units = _units_that_fit(line, remaining, max_cbm - container["cbm"], max_kg - container["gross_kg"])
+            if units:
+                _add_to_container(container, line, units)
+                remaining -= units
+                if remaining <= 0:
+                    break
+
+        while remaining > 0:
+            container = {"container_seq": len(containers) + 1, "cbm": 0.0, "gross_kg": 0.0, "ctns": 0, "lines": []}
+            containers.append(container)
+            open_containers.append(container)
+            units = _units_that_fit(line, remaining, max_cbm, max_kg)
+            _add_to_container(container, line, units)
+            remaining -= units
+
+        open_containers = [
+            c for c in open_containers
+            if max_cbm - c["cbm"] >= min_cbm and max_kg - c["gross_kg"] >= min_kg
+        ]
+
+    for container in containers:
+        container["cbm"] = flt(container["cbm"], 3)
+        container["gross_kg"] = flt(container["gross_kg"], 2)
+        container["fill_cbm_pct"] = flt(container["cbm"] * 100 / max_cbm, 1)
+        container["fill_kg_pct"] = flt(container["gross_kg"] * 100 / max_kg, 1)
+
+    return containers, unplanned
+
+
+def _units_that_fit(line, qty, free_cbm, free_kg):
+    """在剩餘空間內可放入的最大 unit 數"""
+    units = qty
+    if line.unit_cbm > 0:
+        units = min(units, int(free_cbm / line.unit_cbm + 1e-9))
+    if line.unit_kg > 0:
+        units = min(units, int(free_kg / line.unit_kg + 1e-9))
+    return max(units, 0)
+
+
+def _add_to_container(container, line, units):
+    container["cbm"] += units * line.unit_cbm
+    container["gross_kg"] += units * line.unit_kg
+    container["ctns"] += units * line.ctns
+    container["lines"].append({
+        "po_number": line.po_number,
+        "po_line": line.po_line,
+        "line": line.line,
+        "article_number": line.article_number,
+        "article_name": line.article_name,
+        "qty": units,
+        "ctns": line.ctns,
+        "cbm": line.cbm,
+        "gross_kg": line.gross_kg,
+        "unit_price": line.unit_price,
+    })
+
+
+def _apply_plan(to_doc, equipment, containers):
+    """把建議的裝櫃結果寫入 Transport Order Line（每行帶 Container #）"""
+    allocated_lines = [(container["container_seq"], allocated)
+                       for container in containers for allocated in container["lines"]]
+    if not allocated_lines:
+        return
+
+    # supplier 由 PO 表頭帶入
+    po_names = list({allocated["po_number"] for _, allocated in allocated_lines})
+    suppliers = dict(frappe.get_all(
+        "Purchase Order",
+        filters={"name": ["in", po_names]},
+        fields=["name", "supplier"],
+        as_list=True
+    ))
+
+    for container_seq, allocated in sorted(allocated_lines, key=lambda x: (x[0], x[1]["po_number"], x[1]["line"] or 0)):
+        to_doc.append("items", {
+            "po_number": allocated["po_number"],
+            "po_line": allocated["po_line"],
+            "supplier": suppliers.get(allocated["po_number"]),
+            "article_number": allocated["article_number"],
+            "article_name": allocated["article_name"],
+            "qty": allocated["qty"],
+            "ctns": allocated["ctns"],
+            "cbm": allocated["cbm"],
+            "gross_kg": allocated["gross_kg"],
+            "unit_price": allocated["unit_price"],
+            "value": allocated["qty"] * allocated["unit_price"],
+            "container_seq": container_seq,
+        })
+
+    if not to_doc.equipment:
+        to_doc.equipment = equipment
+    to_doc.save()
@@ -6,4 +6,11 @@ from frappe.model.document import Document
 
 
 class Inspection(Document):
-	pass
\ No newline at end of file
+	def on_update(self):
+		# 增量更新檢驗品質統計
+		from hksoho.byrydens.inspection_stats import update_inspection_stats
+		update_inspection_stats(self, previous=self.get_doc_before_save())
+
+	def on_trash(self):
+		from hksoho.byrydens.inspection_stats import update_inspection_stats
+		update_inspection_stats(None, previous=self, deleted=True)
\ No newline at end of file
@@ -6,4 +6,15 @@ from frappe.model.document import Document
 
 
 class InspectionEvent(Document):
-	pass
+	def on_update(self):
+		self.clear_calendar_cache()
+
+	def on_trash(self):
+		self.clear_calendar_cache()
+
+	def clear_calendar_cache(self):
+		# Inspector 的 iCal feed 快取（Inspector 變更時新舊兩人都要清）
+		from hksoho.byrydens.inspection_api import clear_inspector_calendar_cache
+
+		previous = self.get_doc_before_save()
+		clear_inspector_calendar_cache(self.inspector, previous.inspector if previous else None)
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, HKSoHo and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("PO Due Summary", {
+// 	refresh(frm) {
+
+// 	},
+// });
@@ -6,4 +6,13 @@ from frappe.model.document import Document
 
 
 class Product(Document):
-	pass
+	def on_update(self):
+		self.clear_dimensions_cache()
+
+	def on_trash(self):
+		self.clear_dimensions_cache()
+
+	def clear_dimensions_cache(self):
+		# Transport Order 加項時使用的外箱資料快取
+		from hksoho.byrydens.transport_order_api import clear_product_dimensions_cache
+		clear_product_dimensions_cache(self.name)
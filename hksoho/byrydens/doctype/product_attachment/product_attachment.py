@@ -6,4 +6,18 @@ from frappe.model.document import Document
 
 
 class ProductAttachment(Document):
-	pass
+	def on_update(self):
+		self.clear_products_cache()
+
+	def on_trash(self):
+		self.clear_products_cache()
+
+	def clear_products_cache(self):
+		# 附件或其 Product 連結變更時，清除新舊所有相關 Product 的附件 HTML 快取
+		from hksoho.byrydens.product_files_api import clear_product_attachments_cache
+
+		products = [row.product for row in self.product_link]
+		previous = self.get_doc_before_save()
+		if previous:
+			products += [row.product for row in previous.product_link]
+		clear_product_attachments_cache(products)
@@ -1,6 +1,9 @@
 import frappe
 from frappe.model.document import Document
+from frappe.utils import cint, flt
+import hashlib
 import os
+import tempfile
 from datetime import datetime, date
 from datetime import date, datetime, timedelta
 
@@ -13,8 +16,21 @@ OUTPUT_DIR_OWN = "/home/frappe/topyramid"
 LAST_NUMBER_FILE = "/home/frappe/last_number.txt"
 INITIAL_SEQUENCE = 20000
 FIELDS_TO_CHECK = ['po_status']
+# 表頭欄位：變動時所有 11 區塊的指紋都會改變，delta 模式下等同輸出全部項目
+EXPORT_HEADER_FIELDS = ("supplier", "origin_port", "destination_port", "po_shipdate", "order_purchase_currency", "po_status")
 ITEM_FIELDS_TO_CHECK = ['article_number', 'line', 'article_name', 'unit_price', 'confirmed_qty', 'requested_qty', 'confirmed_shipdate']
 LOGGER_NAME = "purchase_order_export"
+# 匯出檔需讓 ftpuser 可讀寫/刪除
+EXPORT_FILE_MODE = 0o666
+# Delta 匯出模式（site_config: pyramid_delta_export = 1）下，完整快照的間隔天數
+DEFAULT_FULL_SNAPSHOT_DAYS = 7
+# 表頭合計欄位，順序須與 get_item_totals() 回傳值一致
+TOTAL_FIELDS = (
+    "total_requested_qty", "total_requested_amount",
+    "total_confirmed_qty", "total_confirmed_amount",
+    "total_booked_qty", "total_booked_amount",
+)
+ITEM_TOTAL_FIELDS = ("unit_price", "requested_qty", "confirmed_qty", "booked_qty")
 
 
 def write_debug_log(message):
@@ -28,60 +44,114 @@ def write_debug_log(message):
     except Exception as e:
         frappe.log_error(f"Failed to write debug log: {str(e)}")
 
+
+def get_item_amount(item):
+    """
+    計算單一項目的金額（unit_price * confirmed_qty）。
+    """
+    uprice = item.get("unit_price")
+    uconf_qty = item.get("confirmed_qty")
+    if uprice is None or uconf_qty is None:
+        return 0.0
+    return uprice * uconf_qty
+
+
+def get_item_totals(item):
+    """
+    回傳單一項目對表頭合計的貢獻，順序同 TOTAL_FIELDS。
+    """
+    uprice = item.get("unit_price")
+    ureq_qty = item.get("requested_qty")
+    ubook_qty = item.get("booked_qty")
+    return [
+        ureq_qty or 0,
+        uprice * ureq_qty if (uprice is not None and ureq_qty is not None) else 0.0,
+        item.get("confirmed_qty") or 0,
+        get_item_amount(item),
+        ubook_qty or 0,
+        uprice * ubook_qty if (uprice is not None and ubook_qty is not None) else 0.0,
+    ]
+
+
+def sum_item_totals(items):
+    """
+    加總多個項目的合計貢獻，順序同 TOTAL_FIELDS。
+    """
+    totals = [0] * len(TOTAL_FIELDS)
+    for item in items:
+        totals = [t + v for t, v in zip(totals, get_item_totals(item))]
+    return totals
+
+
+def round_totals(totals):
+    """
+    數量取整數、金額四捨五入到 2 位，避免浮點誤差累積。
+    """
+    return [
+        flt(value, 2) if fieldname.endswith("_amount") else cint(value)
+        for fieldname, value in zip(TOTAL_FIELDS, totals)
+    ]
+
+
 class PurchaseOrder(Document):
     def before_validate(self):
         """
         在驗證前計算總確認數量、總確認金額、總預訂數量和總預訂金額。
+        既有單據以存檔前的表頭合計為準，只套用新增 / 修改 / 刪除項目的差額；
+        新單據或 flags.recalculate_totals 時全部重算。
+        表頭合計若被繞過存檔的更新弄亂，由 repair_po_totals 或 flags.recalculate_totals 修正。
         """
         logger = frappe.logger(LOGGER_NAME)
         
         try:
             write_debug_log(f"validate triggered for PO: {self.name}")
             logger.info(f"validate triggered for Purchase Order: {self.name}")
-            treq_qty = 0
-            treq_amt = 0.0
-            tconf_qty = 0
-            tconf_amt = 0.0
-            tbook_qty = 0
-            tbook_amt = 0.0
+
+            previous = None if self.is_new() else self.get_doc_before_save()
+            previous_items = {row.name: row for row in previous.po_items} if previous else {}
+
             actualfinishdate = self.actual_finish_date
-            write_debug_log(f"set item {actualfinishdate}")
-            if actualfinishdate:
-                for item in self.po_items:
-                    write_debug_log(f"set item {item.idx} actual_finishdate")
-                    item.actual_finishdate = actualfinishdate
-            write_debug_log(f" ###2 validate triggered for PO: {self.name}")
+            changed_items = []
             for item in self.po_items:
-                uprice = item.unit_price
-                uconf_qty = item.confirmed_qty
-                ubook_qty = item.booked_qty
-                ureq_qty = item.requested_qty
+                if actualfinishdate and item.actual_finishdate != actualfinishdate:
+                    item.actual_finishdate = actualfinishdate
 
-                if uprice is None or uconf_qty is None:	
-                    item.amount = 0.0
-                else:
-                    item.amount = uprice * uconf_qty
-                    
-                if uprice is None or ureq_qty is None:	
-                    req_amt = 0.0
-                else:
-                    req_amt = uprice * ureq_qty
-
-                treq_qty += ureq_qty or 0
-                treq_amt += req_amt or 0.0
-
-                tconf_qty += uconf_qty or 0
-                tconf_amt += item.amount or 0.0
-                tbook_qty += item.booked_qty or 0
-                tbook_amt += uprice * ubook_qty if (uprice is not None and ubook_qty is not None) else 0.0
-
-            self.total_confirmed_qty = tconf_qty
-            self.total_confirmed_amount = tconf_amt
-            self.total_booked_qty = tbook_qty
-            self.total_booked_amount = tbook_amt
-            self.total_requested_qty = treq_qty
-            self.total_requested_amount = treq_amt            
-            write_debug_log(f"##Purchase Order: {self.name} , req_QTY {self.total_requested_qty}")
+                old_item = previous_items.get(item.name)
+                if old_item is None or any(old_item.get(f) != item.get(f) for f in ITEM_TOTAL_FIELDS):
+                    changed_items.append((old_item, item))
+
+            # 已刪除的項目：從合計中扣除
+            current_names = {item.name for item in self.po_items}
+            removed_items = [row for name, row in previous_items.items() if name not in current_names]
+
+            full_recompute = (
+                previous is None
+                or self.flags.recalculate_totals
+                or any(previous.get(f) is None for f in TOTAL_FIELDS)
+            )
+
+            if full_recompute:
+                for item in self.po_items:
+                    item.amount = get_item_amount(item)
+                totals = sum_item_totals(self.po_items)
+            else:
+                totals = [previous.get(f) for f in TOTAL_FIELDS]
+                for old_item, item in changed_items:
+                    item.amount = get_item_amount(item)
+                    old_totals = get_item_totals(old_item) if old_item else [0] * len(TOTAL_FIELDS)
+                    totals = [t + v - o for t, v, o in zip(totals, get_item_totals(item), old_totals)]
+                for old_item in removed_items:
+                    totals = [t - o for t, o in zip(totals, get_item_totals(old_item))]
+            totals = round_totals(totals)
+
+            for fieldname, value in zip(TOTAL_FIELDS, totals):
+                self.set(fieldname, value)
+            # QC 已接受數量也可能由 update_qc_accepted_qty 以 SQL 直接累加，每次存檔都重新加總
+            self.total_qc_accepted_qty = sum(item.qc_accepted_qty or 0 for item in self.po_items)
+            write_debug_log(
+                f"##Purchase Order: {self.name} , req_QTY {self.total_requested_qty}, "
+                f"changed items {len(changed_items)}, removed items {len(removed_items)}, full recompute {bool(full_recompute)}"
+            )
         except Exception as e:
             frappe.log_error(f"Validate failed for PO: {self.name}, error: {str(e)}")
             write_debug_log(f"validate failed for PO: {self.name}, error: {str(e)}")
@@ -126,6 +196,9 @@ class PurchaseOrder(Document):
             return
 
         # 處理採購訂單項目
+        header_len = len(content)
+        export_header = content[:header_len] + [f"{f}={self.get(f) or ''}" for f in EXPORT_HEADER_FIELDS]
+        item_blocks = []
         try:
             for item in self.po_items:
                 if self.workflow_state == "Confirmed" and self.qc_requested:
@@ -157,6 +230,7 @@ class PurchaseOrder(Document):
                         write_debug_log(f"Invalid confirmed_shipdate format for item {item.article_number}: {conf_date}, error: {str(e)}")
                         conf_date = ''             
                            
+                block_start = len(content)
                 content.append("11")
                 article_number = item.article_number or item.item_code or ''
                 content.append(f"#12401;{article_number}")
@@ -209,6 +283,7 @@ class PurchaseOrder(Document):
                     # 新增 container_no（如有的話）
                     container_no = item.container_no or ""
                     content.append(f"¤18541;{container_no}")
+                item_blocks.append((item, content[block_start:]))
             logger.info(f"Processed {len(self.po_items)} items for PO: {po_id}")
             write_debug_log(f"Processed {len(self.po_items)} items for PO: {po_id}")
         except Exception as e:
@@ -217,18 +292,35 @@ class PurchaseOrder(Document):
             write_debug_log(f"Failed to process PO items for {po_id}: {str(e)}")
             return
 
+        # Delta 模式：只輸出指紋有變動的 11 區塊，到期時改為輸出完整快照
+        delta_mode = is_delta_export_enabled() and not self.is_full_snapshot_due()
+        exported_blocks = item_blocks
+        if delta_mode:
+            exported_blocks = [
+                (item, block) for item, block in item_blocks
+                if item.get("export_fingerprint") != get_block_fingerprint(export_header, block)
+            ]
+            if not exported_blocks:
+                logger.info(f"No changed lines for PO: {self.name}, skipping delta export")
+                write_debug_log(f"No changed lines for PO: {self.name}, skipping delta export")
+                return
+            content = content[:header_len] + [line for _, block in exported_blocks for line in block]
+            logger.info(f"Delta export for PO: {self.name}, {len(exported_blocks)} of {len(item_blocks)} lines changed")
+            write_debug_log(f"Delta export for PO: {self.name}, {len(exported_blocks)} of {len(item_blocks)} lines changed")
+
         # 將內容轉換為字串以進行比較
         new_content_str = "\n".join(content)
 
-        # 檢查 latest_file_number 的檔案內容
+        # 檢查 latest_file_number 的檔案內容（delta 檔無法與完整內容比較，略過）
         latest_file_number = self.get('latest_file_number') or ''
-        if latest_file_number:
+        if latest_file_number and not delta_mode:
             try:
                 latest_file_path = os.path.join(OUTPUT_DIR_OWN, f"{latest_file_number}.txt")
                 if os.path.exists(latest_file_path):
                     with open(latest_file_path, "r", encoding="cp1252") as f:
                         existing_content = f.read()
                     if existing_content == new_content_str:
+                        self.mark_exported(export_header, exported_blocks, full_snapshot=True)
                         logger.info(f"Content for PO: {self.name} matches existing file {latest_file_number}, skipping export")
                         write_debug_log(f"Content for PO: {self.name} matches existing file {latest_file_number}, skipping export")
                         return
@@ -245,8 +337,9 @@ class PurchaseOrder(Document):
 
         # 定義輸出目錄
         try:
+            os.makedirs(OUTPUT_DIR_OWN, exist_ok=True)
             os.makedirs(OUTPUT_DIR, exist_ok=True)
-            write_debug_log(f"Created or verified directory: {OUTPUT_DIR}")
+            write_debug_log(f"Created or verified directories: {OUTPUT_DIR_OWN}, {OUTPUT_DIR}")
         except Exception as e:
             logger.error(f"Failed to create directory {OUTPUT_DIR}: {str(e)}")
             frappe.log_error(f"Purchase Order export directory creation failed: {str(e)}")
@@ -258,7 +351,6 @@ class PurchaseOrder(Document):
             sequence = get_next_sequence_number()
             file_name = f"B{sequence}.txt"
             file_path = os.path.join(OUTPUT_DIR_OWN, file_name)
-            file_path_ftp = os.path.join(OUTPUT_DIR, file_name)
             
             logger.info(f"Generating file: {file_path}")
             write_debug_log(f"Generating file: {file_path}")
@@ -278,13 +370,10 @@ class PurchaseOrder(Document):
             write_debug_log(f"Failed to update latest_file_number for PO: {self.name}: {str(e)}")
             return
 
-        os.umask(0)
-        # 寫入檔案內容
+        # 寫入檔案內容（只寫一次，FTP 目錄以 hardlink 發佈）
         try:
-            with open(file_path, "w", encoding="cp1252") as f:
-                f.write(new_content_str)
-            with open(file_path_ftp, "w", encoding="cp1252") as f:
-                f.write(new_content_str)
+            write_export_file(file_name, new_content_str)
+            self.mark_exported(export_header, exported_blocks, full_snapshot=not delta_mode)
             logger.info(f"Successfully wrote file: {file_path}")
             write_debug_log(f"Successfully wrote file: {file_path}")
         except Exception as e:
@@ -292,8 +381,32 @@ class PurchaseOrder(Document):
             frappe.log_error(f"Purchase Order file write failed: {str(e)}")
             write_debug_log(f"Failed to write file {file_path}: {str(e)}")
 
-    
-    
+    def is_full_snapshot_due(self):
+        """
+        Delta 模式下，從未輸出過完整快照或距上次完整快照已超過設定天數時，需輸出完整快照。
+        """
+        if not self.get("last_full_export"):
+            return True
+        days = frappe.utils.cint(frappe.conf.get("pyramid_full_snapshot_days")) or DEFAULT_FULL_SNAPSHOT_DAYS
+        return frappe.utils.get_datetime(self.last_full_export) <= frappe.utils.add_days(frappe.utils.now_datetime(), -days)
+
+    def mark_exported(self, export_header, exported_blocks, full_snapshot):
+        """
+        記錄已匯出項目的指紋；完整快照時一併更新 last_full_export。
+        """
+        for item, block in exported_blocks:
+            item.export_fingerprint = get_block_fingerprint(export_header, block)
+        if full_snapshot:
+            self.last_full_export = frappe.utils.now_datetime()
+
+    def on_update(self):
+        # 更新 Orders Due to Pay 彙總表
+        from hksoho.byrydens.orders_due_api import update_po_due_summary
+        update_po_due_summary([self.name])
+
+    def on_trash(self):
+        frappe.db.delete("PO Due Summary", {"purchase_order": self.name})
+
     def after_save(self):
         """
         測試 after_save 事件是否被觸發。
@@ -308,6 +421,65 @@ class PurchaseOrder(Document):
             frappe.log_error(f"After_save failed for PO: {self.name}, error: {str(e)}")
             write_debug_log(f"after_save failed for PO: {self.name}, error: {str(e)}")
 
+def is_delta_export_enabled():
+    """
+    是否啟用 Pyramid delta 匯出（只輸出有變動的 11 區塊）。
+    """
+    return bool(frappe.utils.cint(frappe.conf.get("pyramid_delta_export")))
+
+
+def get_block_fingerprint(export_header, block):
+    """
+    計算單一 11 區塊內容（含表頭）的指紋，用於判斷該項目自上次匯出後是否有變動。
+    """
+    return hashlib.sha1("\n".join(export_header + block).encode("utf-8")).hexdigest()
+
+
+def _atomic_write(directory, path, data):
+    """
+    先寫入同目錄的暫存檔並 fsync，再以 os.replace 原子性地改名為 path。
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, EXPORT_FILE_MODE)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def write_export_file(file_name, content):
+    """
+    將匯出內容寫入 OUTPUT_DIR_OWN（存檔），再以 hardlink 發佈到 FTP 目錄 OUTPUT_DIR。
+    兩個目錄都只會出現完整的檔案；若無法建立 hardlink（例如跨檔案系統），
+    改為在 OUTPUT_DIR 另寫暫存檔再 rename。
+    """
+    logger = frappe.logger(LOGGER_NAME)
+    data = content.encode("cp1252")
+    archive_path = os.path.join(OUTPUT_DIR_OWN, file_name)
+    ftp_path = os.path.join(OUTPUT_DIR, file_name)
+
+    _atomic_write(OUTPUT_DIR_OWN, archive_path, data)
+
+    link_tmp_path = os.path.join(OUTPUT_DIR, f".{file_name}.part")
+    try:
+        if os.path.lexists(link_tmp_path):
+            os.unlink(link_tmp_path)
+        os.link(archive_path, link_tmp_path)
+        os.replace(link_tmp_path, ftp_path)
+    except OSError as e:
+        logger.warning(f"Hardlink to {ftp_path} failed ({str(e)}), falling back to copy")
+        write_debug_log(f"Hardlink to {ftp_path} failed ({str(e)}), falling back to copy")
+        _atomic_write(OUTPUT_DIR, ftp_path, data)
+
+    return archive_path
+
+
 def get_next_sequence_number():
     """
     從 last_number.txt 獲取下一個序號，從 20000 開始。
@@ -346,4 +518,63 @@ def get_next_sequence_number():
         frappe.log_error(f"Sequence number write failed: {str(e)}")
         write_debug_log(f"Failed to write {LAST_NUMBER_FILE}: {str(e)}")
 
-    return sequence
\ No newline at end of file
+    return sequence
+
+
+@frappe.whitelist()
+def repair_po_totals(po_name=None):
+    """
+    以 SQL 一次修正所有（或指定）採購訂單的項目金額與表頭合計欄位（含 QC 已接受數量）。
+    用於增量合計出現偏差時的修復，不觸發 before_save，不會重新匯出檔案。
+    """
+    frappe.only_for("System Manager")
+    logger = frappe.logger(LOGGER_NAME)
+
+    item_condition = "WHERE parent = %(po_name)s" if po_name else ""
+    sub_condition = "AND parent = %(po_name)s" if po_name else ""
+    po_condition = "WHERE po.name = %(po_name)s" if po_name else ""
+    values = {"po_name": po_name}
+
+    frappe.db.sql(f"""
+        UPDATE `tabPurchase Order Item`
+        SET amount = IFNULL(unit_price, 0) * IFNULL(confirmed_qty, 0)
+        {item_condition}
+    """, values)
+
+    frappe.db.sql(f"""
+        UPDATE `tabPurchase Order` po
+        LEFT JOIN (
+            SELECT
+                parent,
+                SUM(IFNULL(requested_qty, 0)) AS req_qty,
+                SUM(IFNULL(unit_price, 0) * IFNULL(requested_qty, 0)) AS req_amt,
+                SUM(IFNULL(confirmed_qty, 0)) AS conf_qty,
+                SUM(IFNULL(unit_price, 0) * IFNULL(confirmed_qty, 0)) AS conf_amt,
+                SUM(IFNULL(booked_qty, 0)) AS book_qty,
+                SUM(IFNULL(unit_price, 0) * IFNULL(booked_qty, 0)) AS book_amt,
+                SUM(IFNULL(qc_accepted_qty, 0)) AS qc_qty
+            FROM `tabPurchase Order Item`
+            WHERE parenttype = 'Purchase Order' {sub_condition}
+            GROUP BY parent
+        ) t ON t.parent = po.name
+        SET
+            po.total_requested_qty = IFNULL(t.req_qty, 0),
+            po.total_requested_amount = IFNULL(t.req_amt, 0),
+            po.total_confirmed_qty = IFNULL(t.conf_qty, 0),
+            po.total_confirmed_amount = IFNULL(t.conf_amt, 0),
+            po.total_booked_qty = IFNULL(t.book_qty, 0),
+            po.total_booked_amount = IFNULL(t.book_amt, 0),
+            po.total_qc_accepted_qty = IFNULL(t.qc_qty, 0)
+        {po_condition}
+    """, values)
+
+    # 同步 Orders Due to Pay 彙總表：單張 PO 直接更新，全部修正時排入背景重建
+    from hksoho.byrydens.orders_due_api import enqueue_po_due_summary_rebuild, update_po_due_summary
+    if po_name:
+        update_po_due_summary([po_name])
+    else:
+        enqueue_po_due_summary_rebuild()
+
+    frappe.db.commit()
+    logger.info(f"Repaired Purchase Order totals for {po_name or 'all POs'}")
+    return {"status": "success", "po_name": po_name}
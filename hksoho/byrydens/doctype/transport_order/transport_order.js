@@ -26,46 +26,32 @@ frappe.ui.form.on('Transport Order', {
                 return;
             }
 
-            let processed = 0;
-            let skipped = 0;
-
-            rows_with_article.forEach(function(row) {
-                frappe.call({
-                    method: 'frappe.client.get',
-                    args: {
-                        doctype: 'Product',
-                        name: row.article_number
-                    },
-                    callback: function(r) {
-                        if (r.message) {
-                            let product = r.message;
-
-                            // 填入對應欄位（外箱資料）
-                            frappe.model.set_value(row.doctype, row.name, 'ctns', 
-                                product.number_of_cartons_colli_per_unit || 1);
-
-                            frappe.model.set_value(row.doctype, row.name, 'cbm', 
-                                product.carton_cbm_outer_carton || 0);
-
-                            frappe.model.set_value(row.doctype, row.name, 'gross_kg', 
-                                product.carton_weight_kg_outer_carton || 0);
-
-                            processed++;
-                        } else {
-                            skipped++;
-                        }
-
-                        // 所有有 Article Number 的行都處理完後顯示結果
-                        if (processed + skipped === rows_with_article.length) {
-                            frm.refresh_field('items');
-                            frappe.msgprint({
-                                title: 'Completed',
-                                message: `Successfully loaded data for ${processed} item(s).<br>Skipped ${skipped} item(s).`,
-                                indicator: 'green'
-                            });
-                        }
+            let article_numbers = [...new Set(rows_with_article.map(row => row.article_number))];
+
+            // 一次取回所有 Article 的外箱資料
+            get_product_dimensions(article_numbers).then(dimensions => {
+                let processed = 0;
+                let skipped = 0;
+
+                rows_with_article.forEach(function(row) {
+                    let product = dimensions[row.article_number];
+                    if (product) {
+                        // 填入對應欄位（外箱資料）
+                        frappe.model.set_value(row.doctype, row.name, 'ctns', product.ctns || 1);
+                        frappe.model.set_value(row.doctype, row.name, 'cbm', product.cbm || 0);
+                        frappe.model.set_value(row.doctype, row.name, 'gross_kg', product.gross_kg || 0);
+                        processed++;
+                    } else {
+                        skipped++;
                     }
                 });
+
+                frm.refresh_field('items');
+                frappe.msgprint({
+                    title: 'Completed',
+                    message: `Successfully loaded data for ${processed} item(s).<br>Skipped ${skipped} item(s).`,
+                    indicator: 'green'
+                });
             });
         });  // 按鈕顯示在 Actions 群組
 
@@ -93,11 +79,15 @@ frappe.ui.form.on('Transport Order', {
                             size: 'extra-large',
                             fields: [
                                 {
-                                    label: 'Select Purchase Order',
+                                    label: 'Select Purchase Orders',
                                     fieldname: 'po_select',
-                                    fieldtype: 'Select',
-                                    options: po_options,
+                                    fieldtype: 'MultiSelectList',
                                     reqd: 1,
+                                    get_data: function(txt) {
+                                        return po_options
+                                            .filter(po => !txt || po.toLowerCase().includes(txt.toLowerCase()))
+                                            .map(po => ({ value: po, description: '' }));
+                                    },
                                     change: function() {
                                         refreshTable(d);
                                     }
@@ -111,10 +101,10 @@ frappe.ui.form.on('Transport Order', {
                             primary_action_label: 'Add Selected Items',
                             primary_action: function() {
                                 let selected_items = [];
-                                let po_name = d.get_value('po_select');
                                 $(d.$wrapper).find('input[name="item_select"]:checked').each(function() {
                                     selected_items.push({
                                         name: $(this).val(),
+                                        po_number: $(this).data('po-number'),
                                         line: $(this).data('line'),
                                         article_number: $(this).data('article-number'),
                                         article_name: $(this).data('article-name'),
@@ -150,7 +140,7 @@ frappe.ui.form.on('Transport Order', {
                                 // Add selected items to Transport Order Line child table
                                 selected_items.forEach(item => {
                                     let row = frm.add_child('items');
-                                    row.po_number = po_name;
+                                    row.po_number = item.po_number;
                                     row.po_line = item.name;
                                     row.article_number = item.article_number;
                                     row.article_name = item.article_name;
@@ -182,23 +172,29 @@ frappe.ui.form.on('Transport Order', {
                         // Define function to refresh table
 
                         function refreshTable(dialog) {
-                            let po_name = dialog.get_value('po_select');
-                            if (!po_name) {
+                            let po_names = dialog.get_value('po_select') || [];
+                            if (!po_names.length) {
                                 dialog.fields_dict.items_table.$wrapper.empty();
                                 dialog.get_primary_btn().prop('disabled', true);
                                 return;
                             }
 
+                            // 一次取回所有選取 PO 的可出貨明細（依 PO 分組）
                             frappe.call({
-                                method: 'hksoho.byrydens.transport_order_api.get_po_items',
+                                method: 'hksoho.byrydens.transport_order_api.get_po_items_batch',
                                 args: {
-                                    po_name: po_name
+                                    po_names: po_names
                                 },
                                 callback: function(r) {
                                     let $container = dialog.fields_dict.items_table.$wrapper;
                                     $container.empty();
 
-                                    if (r.message && Array.isArray(r.message) && r.message.length > 0) {
+                                    let po_items = [];
+                                    po_names.forEach(po => {
+                                        ((r.message || {})[po] || []).forEach(item => po_items.push(item));
+                                    });
+
+                                    if (po_items.length > 0) {
                                         let table = $(`
                                             <table class="table table-bordered" style="width: 100%;">
                                                 <thead>
@@ -207,9 +203,10 @@ frappe.ui.form.on('Transport Order', {
                                                             <input type="checkbox" id="select_all_items">
                                                             Select
                                                         </th>
+                                                        <th style="width: 10%;">PO</th>
                                                         <th style="width: 5%;">Line</th>
                                                         <th style="width: 15%;">Article #</th>
-                                                        <th style="width: 25%;">Article Name</th>
+                                                        <th style="width: 15%;">Article Name</th>
                                                         <th style="width: 10%;">Qty</th>
                                                         <th style="width: 10%;">Ctns</th>
                                                         <th style="width: 10%;">CBM</th>
@@ -229,99 +226,41 @@ frappe.ui.form.on('Transport Order', {
 
                                         let tbody = table.find('tbody');
 
-                                        // 批次處理所有項目的 Product 資料
-                                        let items = r.message;
-                                        let processed = 0;
+                                        // 一次取回所有項目的 Product 外箱資料
+                                        let items = po_items;
+                                        let article_numbers = [...new Set(items.map(item => item.article_number).filter(Boolean))];
+
+                                        get_product_dimensions(article_numbers).then(dimensions => {
+                                            items.forEach(item => {
+                                                let qty = (item.booked_qty || 0) - (item.delivery_qty || 0);
+                                                let article_number = item.article_number || '';
+
+                                                // 預設值先用 PO 的（若有），有 Product 資料則用 Product 的標準外箱資料
+                                                let display_ctns = item.ctns_on_pallet || 0;
+                                                let display_cbm = item.carton_cbm || 0;
+                                                let display_gross_kg = item.carton_gross_kg || 0;
+                                                let product = dimensions[article_number];
+                                                if (product) {
+                                                    display_ctns = product.ctns || 1;
+                                                    display_cbm = product.cbm || 0;
+                                                    display_gross_kg = product.gross_kg || 0;
+                                                }
 
-                                        items.forEach((item, index) => {
-                                            let qty = (item.booked_qty || 0) - (item.delivery_qty || 0);
-                                            let article_number = item.article_number || '';
-
-                                            // 預設值先用 PO 的（若有）
-                                            let display_ctns = item.ctns_on_pallet || 0;
-                                            let display_cbm = item.carton_cbm || 0;
-                                            let display_gross_kg = item.carton_gross_kg || 0;
-
-                                            // 如果有 article_number，就去抓 Product 的標準外箱資料
-                                            if (article_number) {
-                                                frappe.db.get_doc('Product', article_number).then(product => {
-                                                    if (product) {
-                                                        display_ctns = product.number_of_cartons_colli_per_unit || 1;
-                                                        display_cbm = product.carton_cbm_outer_carton || 0;
-                                                        display_gross_kg = product.carton_weight_kg_outer_carton || 0;
-                                                    }
-
-                                                    // 動態新增表格列
-                                                    tbody.append(`
-                                                        <tr>
-                                                            <td><input type="checkbox" name="item_select" value="${item.name}" 
-                                                                data-line="${item.line || ''}" 
-                                                                data-article-number="${article_number}" 
-                                                                data-article-name="${item.article_name || ''}" 
-                                                                data-qty="${qty}" 
-                                                                data-ctns="${display_ctns}" 
-                                                                data-cbm="${display_cbm}" 
-                                                                data-gross-kg="${display_gross_kg}" 
-                                                                data-unit-price="${item.unit_price || 0}"></td>
-                                                            <td>${item.line || ''}</td>
-                                                            <td>${article_number}</td>
-                                                            <td>${item.article_name || ''}</td>
-                                                            <td>${qty}</td>
-                                                            <td>${display_ctns}</td>
-                                                            <td>${display_cbm}</td>
-                                                            <td>${display_gross_kg}</td>
-                                                            <td>${item.unit_price || 0}</td>
-                                                        </tr>
-                                                    `);
-
-                                                    processed++;
-                                                    if (processed === items.length) {
-                                                        setupCheckboxEvents();
-                                                    }
-                                                }).catch(() => {
-                                                    // 若抓不到 Product，維持 PO 原值
-                                                    tbody.append(`
-                                                        <tr>
-                                                            <td><input type="checkbox" name="item_select" value="${item.name}" 
-                                                                data-line="${item.line || ''}" 
-                                                                data-article-number="${article_number}" 
-                                                                data-article-name="${item.article_name || ''}" 
-                                                                data-qty="${qty}" 
-                                                                data-ctns="${display_ctns}" 
-                                                                data-cbm="${display_cbm}" 
-                                                                data-gross-kg="${display_gross_kg}" 
-                                                                data-unit-price="${item.unit_price || 0}"></td>
-                                                            <td>${item.line || ''}</td>
-                                                            <td>${article_number}</td>
-                                                            <td>${item.article_name || ''}</td>
-                                                            <td>${qty}</td>
-                                                            <td>${display_ctns}</td>
-                                                            <td>${display_cbm}</td>
-                                                            <td>${display_gross_kg}</td>
-                                                            <td>${item.unit_price || 0}</td>
-                                                        </tr>
-                                                    `);
-
-                                                    processed++;
-                                                    if (processed === items.length) {
-                                                        setupCheckboxEvents();
-                                                    }
-                                                });
-                                            } else {
-                                                // 沒有 article_number，直接用 PO 值
                                                 tbody.append(`
                                                     <tr>
                                                         <td><input type="checkbox" name="item_select" value="${item.name}" 
+                                                            data-po-number="${item.po_number}" 
                                                             data-line="${item.line || ''}" 
-                                                            data-article-number="" 
+                                                            data-article-number="${article_number}" 
                                                             data-article-name="${item.article_name || ''}" 
                                                             data-qty="${qty}" 
                                                             data-ctns="${display_ctns}" 
                                                             data-cbm="${display_cbm}" 
                                                             data-gross-kg="${display_gross_kg}" 
                                                             data-unit-price="${item.unit_price || 0}"></td>
+                                                        <td>${item.po_number}</td>
                                                         <td>${item.line || ''}</td>
-                                                        <td></td>
+                                                        <td>${article_number}</td>
                                                         <td>${item.article_name || ''}</td>
                                                         <td>${qty}</td>
                                                         <td>${display_ctns}</td>
@@ -330,12 +269,9 @@ frappe.ui.form.on('Transport Order', {
                                                         <td>${item.unit_price || 0}</td>
                                                     </tr>
                                                 `);
+                                            });
 
-                                                processed++;
-                                                if (processed === items.length) {
-                                                    setupCheckboxEvents();
-                                                }
-                                            }
+                                            setupCheckboxEvents();
                                         });
 
                                         // 獨立出 checkbox 事件綁定，避免重複綁定
@@ -919,6 +855,17 @@ function toggleVesselSection(frm) {
     }
 }
 
+// 一次取回多個 Article 的外箱資料：{article_number: {ctns, cbm, gross_kg}}
+function get_product_dimensions(article_numbers) {
+    if (!article_numbers || article_numbers.length === 0) {
+        return Promise.resolve({});
+    }
+    return frappe.call({
+        method: 'hksoho.byrydens.transport_order_api.get_product_dimensions',
+        args: { article_numbers: article_numbers }
+    }).then(r => r.message || {});
+}
+
 function calculate_total(frm) {
     let total = 0;
     frm.doc.items.forEach(row => {
@@ -1001,7 +948,7 @@ function updateVesselDates(frm) {
                                     </li>
                                 </ul>
                                 <p style="color:#d63031; margin-top:12px; font-weight:500;">
-                                    Warning: These changes will update BOTH the <strong>Vessels Time Table</strong> record and the current <strong>Transport Order</strong>.
+                                    Warning: These changes will update the <strong>Vessels Time Table</strong> record, the current <strong>Transport Order</strong>, and (in the background) every other <strong>Transport Order</strong> on this vessel.
                                 </p>
                             </div>`
                     }
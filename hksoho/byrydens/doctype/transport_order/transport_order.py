@@ -1,9 +1,90 @@
 # Copyright (c) 2025, HKSoHo and contributors
 # For license information, please see license.txt
 
-# import frappe
+import json
+import math
+
+import frappe
 from frappe.model.document import Document
+from frappe.utils import cint, flt
+
+# 裝載合計欄位（表頭 total_* 與 load_summary 每組的 key）
+LOAD_TOTAL_KEYS = ("qty", "ctns", "cbm", "gross_kg", "pallets", "value")
+
+
+def get_line_load(line, ctns_on_pallet=0):
+	"""
+	回傳單一 Transport Order Line 的裝載量，順序同 LOAD_TOTAL_KEYS。
+	Line 上的 ctns / cbm / gross_kg 與 transport_order.js 的 Add Item 對話框填入的一致：
+	ctns = 每個 unit 的箱數（總箱數 = qty × ctns），cbm / gross_kg = 每箱材積 / 毛重。
+	板數 = 總箱數 ÷ PO 明細的 ctns_on_pallet（每板箱數）無條件進位；不同 Article 不併板，
+	因此逐行進位後再加總。沒有 ctns_on_pallet 的明細不計板數。
+	"""
+	qty = cint(line.qty)
+	ctns = qty * (cint(line.ctns) or 1)
+	return (
+		qty,
+		ctns,
+		ctns * flt(line.cbm),
+		ctns * flt(line.gross_kg),
+		math.ceil(ctns / ctns_on_pallet) if ctns_on_pallet > 0 else 0,
+		flt(line.value),
+	)
 
 
 class TransportOrder(Document):
-	pass
+	def validate(self):
+		self.calculate_load_totals()
+
+	def calculate_load_totals(self):
+		"""一次走過所有明細，計算表頭合計、每張 PO 及每個貨櫃的裝載量"""
+		container = self.container_number or self.equipment or ""
+		totals = [0] * len(LOAD_TOTAL_KEYS)
+		by_po = {}
+		by_container = {}
+		ctns_on_pallet = self.get_ctns_on_pallet()
+
+		for line in self.items:
+			load = get_line_load(line, ctns_on_pallet.get(line.po_line, 0))
+			po_totals = by_po.setdefault(line.po_number or "", [0] * len(LOAD_TOTAL_KEYS))
+			# 有裝櫃規劃（container_seq）的明細依規劃分櫃，否則歸入表頭貨櫃
+			container_key = f"#{line.container_seq}" if line.container_seq else container
+			container_totals = by_container.setdefault(container_key, [0] * len(LOAD_TOTAL_KEYS))
+			for i, value in enumerate(load):
+				totals[i] += value
+				po_totals[i] += value
+				container_totals[i] += value
+
+		self.total_qty = totals[0]
+		self.total_ctns = totals[1]
+		self.total_cbm = flt(totals[2], 3)
+		self.total_gross_kg = flt(totals[3], 2)
+		self.total_pallets = totals[4]
+		self.total_value = flt(totals[5], 2)
+
+		self.load_summary = json.dumps({
+			"by_po": {po: dict(zip(LOAD_TOTAL_KEYS, values)) for po, values in by_po.items()},
+			"by_container": {key: dict(zip(LOAD_TOTAL_KEYS, values)) for key, values in by_container.items()},
+		}, sort_keys=True)
+
+	def get_ctns_on_pallet(self):
+		"""一次查詢所有明細對應 PO Item 的每板箱數：{po_line: ctns_on_pallet}"""
+		po_lines = list({line.po_line for line in self.items if line.po_line})
+		if not po_lines:
+			return {}
+		return {
+			row.name: cint(row.ctns_on_pallet)
+			for row in frappe.get_all(
+				"Purchase Order Item",
+				filters={"name": ["in", po_lines]},
+				fields=["name", "ctns_on_pallet"],
+			)
+		}
+
+	def get_load_summary(self):
+		"""回傳 load_summary（dict），供報表及 API 使用"""
+		if not self.load_summary:
+			return {"by_po": {}, "by_container": {}}
+		if isinstance(self.load_summary, str):
+			return json.loads(self.load_summary)
+		return self.load_summary
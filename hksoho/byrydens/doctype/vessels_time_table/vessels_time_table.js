@@ -1,8 +1,25 @@
 // Copyright (c) 2025, HKSoHo and contributors
 // For license information, please see license.txt
 
-// frappe.ui.form.on("Vessels Time Table", {
-// 	refresh(frm) {
+frappe.ui.form.on("Vessels Time Table", {
+	refresh(frm) {
+		if (frm.doc.__islocal) {
+			return;
+		}
 
-// 	},
-// });
+		frm.add_custom_button(__("Update Transport Orders"), function () {
+			frappe.call({
+				method: "hksoho.byrydens.transport_order_api.cascade_vessel_schedule",
+				args: { vessel_name: frm.doc.name },
+				callback: function (r) {
+					if (!r.exc) {
+						frappe.show_alert({
+							message: __("Transport Order update queued for {0}", [frm.doc.name]),
+							indicator: "blue",
+						});
+					}
+				},
+			});
+		});
+	},
+});
@@ -4,6 +4,23 @@
 # import frappe
 from frappe.model.document import Document
 
+# 變動時需要同步到所有關聯 Transport Order 的欄位
+SCHEDULE_FIELDS = ("cfs_close", "etd_date", "eta_date", "dest_port_free_days")
+
 
 class VesselsTimeTable(Document):
-	pass
+	def on_update(self):
+		# update_vessel_dates 自行同步 Transport Order，設定 flags.skip_schedule_cascade 避免重複
+		if self.flags.skip_schedule_cascade:
+			return
+
+		if self.schedule_changed():
+			from hksoho.byrydens.transport_order_api import enqueue_vessel_schedule_cascade
+
+			enqueue_vessel_schedule_cascade(self.name)
+
+	def schedule_changed(self):
+		"""船期欄位是否有變動（新建的船期尚無 Transport Order 關聯，視為未變動）"""
+		if not self.get_doc_before_save():
+			return False
+		return any(self.has_value_changed(fieldname) for fieldname in SCHEDULE_FIELDS)
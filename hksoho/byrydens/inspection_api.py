@@ -3,11 +3,20 @@ from frappe import _
 from frappe.model.document import Document
 import json
 
-from frappe.utils import format_date, format_time
+from frappe.utils import add_days, cint, format_date, format_time, get_url, now, nowdate
+from frappe.utils.password import get_encryption_key
 from icalendar import Calendar, Event
 from datetime import datetime
+from urllib.parse import urlencode
+from werkzeug.wrappers import Response
+import hashlib
+import hmac
 import io
 
+from hksoho.utils.trace import get_tracer
+
+tracer = get_tracer("inspection_api")
+
 
 @frappe.whitelist()
 def get_suppliers():
@@ -58,10 +67,7 @@ def get_po_items_qcstatus(po_name):
 
     # 檢查用戶對 Purchase Order 的讀取權限
     if not frappe.has_permission("Purchase Order", "read", po_name):
-        frappe.log_error(
-            message=f"User {frappe.session.user} lacks permission to read Purchase Order {po_name}",
-            title="Permission Error in get_po_items_qcstatus"
-        )
+        tracer.warning("User %s lacks permission to read Purchase Order %s", frappe.session.user, po_name)
         frappe.throw(
             _("您沒有足夠的權限訪問此採購訂單，請聯繫管理員以獲取權限。"),
             frappe.PermissionError
@@ -79,11 +85,7 @@ def get_po_items_qcstatus(po_name):
         ignore_permissions=True  # 僅限測試，生產環境應移除
     )
 
-    # 記錄查詢結果
-    frappe.log_error(
-        message=f"Queried PO Items for {po_name}: {len(items)} items found",
-        title="get_po_items_qcstatus"
-    )
+    tracer.debug("Queried PO Items for %s: %s items found", po_name, len(items))
 
     return items
 
@@ -92,6 +94,7 @@ def add_po_items_to_inspection_event(inspection_event_name, selected_items):
     """
     將選中的 Purchase Order Item 添加到 Inspection Event 的 po_items 表（Inspection Line），
     使用 po_number 和 po_item.line 檢查重複，跳過已存在項目並提示。
+    選中的項目可來自多張 PO，但必須屬於同一個 supplier。
     
     Args:
         inspection_event_name (str): Inspection Event 的名稱
@@ -130,27 +133,32 @@ def add_po_items_to_inspection_event(inspection_event_name, selected_items):
     if not items:
         frappe.throw(_("無有效的項目被選擇。"))
 
-    # 獲取當前 po_items 表中的 po_number 和 po_item.line 組合，用於檢查重複
-    existing_items = set()
-    for row in inspection_event.po_items:
-        if row.po_number and row.po_item:
-            po_item = frappe.get_doc("Purchase Order Item", {
-                "parent": row.po_number,
-                "line": row.po_item
-            })
-            if po_item.line is not None:
-                existing_items.add((row.po_number, po_item.line))
+    # 直接由 po_items 子表取得已存在的 (po_number, line) 組合，用於檢查重複
+    existing_items = {
+        (row.po_number, cint(row.po_item))
+        for row in inspection_event.po_items
+        if row.po_number and row.po_item
+    }
     added_count = 0
     skipped_items = []
-    # 假設第一個項目的 supplier 適用於所有項目（因為它們來自同一個 PO）
-    supplier = None
-    if items:
-        po = frappe.get_doc("Purchase Order", items[0].parent)
-        supplier = po.supplier if po.supplier else None
+
+    # 可一次加入多張 PO 的項目，但同一個 Inspection Event 只能有一個 supplier
+    po_suppliers = dict(frappe.get_all(
+        "Purchase Order",
+        filters={"name": ["in", list({item.parent for item in items})]},
+        fields=["name", "supplier"],
+        as_list=True
+    ))
+    suppliers = {supplier for supplier in po_suppliers.values() if supplier}
+    if len(suppliers) > 1:
+        frappe.throw(_("選擇的項目來自不同供應商的採購訂單：{0}").format(", ".join(sorted(suppliers))))
+    supplier = suppliers.pop() if suppliers else None
 
     # 將項目添加到 po_items 表，跳過已存在的項目
-    for item in items:
-        if (item.parent, item.line) not in existing_items:
+    for item in sorted(items, key=lambda i: (i.parent, cint(i.line))):
+        key = (item.parent, cint(item.line))
+        if key not in existing_items:
+            existing_items.add(key)
             inspection_event.append("po_items", {
                 "po_item": item.line,  # Link 到 Purchase Order Item
                 "po_number": item.parent,  # 設置 PO 號碼
@@ -244,17 +252,215 @@ def send_inspection_invitation(inspection_event_name):
     return {"status": "success", "message": _("邀請已發送")}
 
 
+# Inspector 訂閱用 iCal feed（每位 Inspector 一個快取 key: CALENDAR_CACHE_KEY:<inspector>）
+CALENDAR_CACHE_KEY = "hksoho:inspection_calendar"
+# 快取最長保留時間；Inspector / Partner 改名或 SQL 直接寫入不會觸發清除，到期後自動重建
+CALENDAR_CACHE_TTL = 60 * 60
+# feed 只包含近期（過去 N 天起）的事件
+CALENDAR_PAST_DAYS = 90
+ICS_STATUS = {"Open": "CONFIRMED", "Completed": "CONFIRMED", "Closed": "CONFIRMED", "Cancelled": "CANCELLED"}
+
+
+@frappe.whitelist(allow_guest=True)
+def get_inspector_calendar(inspector, token):
+    """
+    Subscribable iCalendar feed of an inspector's Inspection Events.
+
+    Calendar clients cannot log in, so the URL carries a per-inspector token
+    (see get_inspector_calendar_url). The rendered feed is cached until an
+    Inspection Event of the inspector changes, and ETag / If-None-Match lets
+    polling clients get a 304 without a body. Cached feeds also expire after
+    CALENDAR_CACHE_TTL seconds.
+    """
+    if not token or not hmac.compare_digest(token, get_calendar_token(inspector)):
+        raise frappe.PermissionError
+
+    cache_key = f"{CALENDAR_CACHE_KEY}:{inspector}"
+    cached = frappe.cache().get_value(cache_key)
+    if not cached:
+        ics = build_inspector_calendar(inspector)
+        cached = {"etag": hashlib.sha1(ics).hexdigest(), "ics": ics}
+        frappe.cache().set_value(cache_key, cached, expires_in_sec=CALENDAR_CACHE_TTL)
+
+    response = Response(cached["ics"], mimetype="text/calendar")
+    response.headers["Content-Disposition"] = 'inline; filename="inspections.ics"'
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.set_etag(cached["etag"])
+    return response.make_conditional(frappe.request)
+
+
+@frappe.whitelist()
+def get_inspector_calendar_url(inspector=None):
+    """回傳 Inspector 的 iCal 訂閱網址（只能取得自己的，System Manager 可取得任何人的）"""
+    inspector = inspector or frappe.session.user
+    if inspector != frappe.session.user:
+        frappe.only_for("System Manager")
+
+    return get_url(
+        "/api/method/hksoho.byrydens.inspection_api.get_inspector_calendar?"
+        + urlencode({"inspector": inspector, "token": get_calendar_token(inspector)})
+    )
+
+
+def get_calendar_token(inspector):
+    """由 site 的 encryption key 產生每位 Inspector 固定的 feed token"""
+    return hmac.new(
+        get_encryption_key().encode(), f"inspection-calendar:{inspector}".encode(), hashlib.sha256
+    ).hexdigest()
+
+
+def build_inspector_calendar(inspector):
+    """一次查詢 Inspector 的所有近期事件並產生 .ics 內容"""
+    events = frappe.db.sql("""
+        SELECT ev.name, ev.starts_on, ev.ends_on, ev.status, ev.description,
+               ev.supplier, partner.partner_name, ev.modified
+        FROM `tabInspection Event` ev
+        LEFT JOIN `tabPartner` partner ON partner.name = ev.supplier
+        WHERE ev.inspector = %(inspector)s
+          AND ev.starts_on >= %(since)s
+        ORDER BY ev.starts_on
+    """, {"inspector": inspector, "since": add_days(nowdate(), -CALENDAR_PAST_DAYS)}, as_dict=True)
+
+    cal = Calendar()
+    cal.add('prodid', '-//By Rydéns ERP//')
+    cal.add('version', '2.0')
+    cal.add('x-wr-calname', 'Inspection Events')
+
+    for doc in events:
+        event = Event()
+        event.add('summary', f"Inspection Event: {doc.name}")
+        event.add('dtstart', doc.starts_on)
+        event.add('dtend', doc.ends_on or doc.starts_on)
+        event.add('description', doc.description or "No description")
+        event.add('location', doc.partner_name or doc.supplier or "N/A")
+        event.add('uid', f"{doc.name}@byrydens.com")
+        event.add('status', ICS_STATUS.get(doc.status, "CONFIRMED"))
+        event.add('last-modified', doc.modified)
+        cal.add_component(event)
+
+    return cal.to_ical()
+
+
+def clear_inspector_calendar_cache(*inspectors):
+    """Inspection Event 變更時清除相關 Inspector 的 feed 快取"""
+    for inspector in set(inspectors):
+        if inspector:
+            frappe.cache().delete_value(f"{CALENDAR_CACHE_KEY}:{inspector}")
+
+
 @frappe.whitelist()
 def update_qc_accepted_qty(purchase_order, line_number, aql_qty):
     try:
-        po_item = frappe.get_doc("Purchase Order Item", {
-            "parent": purchase_order,
-            "line": line_number
-        })
-        po_item.qc_accepted_qty = (po_item.qc_accepted_qty or 0) + aql_qty
-        po_item.save(ignore_permissions=True)
+        updated = apply_qc_accepted_qty([{
+            "purchase_order": purchase_order,
+            "line_number": line_number,
+            "aql_qty": aql_qty
+        }])
         frappe.db.commit()
-        return {"success": True, "qc_accepted_qty": po_item.qc_accepted_qty}
+        return {"success": True, "qc_accepted_qty": updated[0]["qc_accepted_qty"]}
     except Exception as e:
+        frappe.db.rollback()
         frappe.log_error(frappe.get_traceback(), "update_qc_accepted_qty")
-        return {"success": False, "error": str(e)}
\ No newline at end of file
+        return {"success": False, "error": str(e)}
+
+
+@frappe.whitelist()
+def update_qc_accepted_qty_batch(results):
+    """
+    一次套用多筆檢驗結果（同一個 transaction），各 PO 的合計只更新一次。
+
+    Args:
+        results (str or list): [{"purchase_order", "line_number", "aql_qty"}, ...]
+    Returns:
+        dict: {"success": True, "updated": [{"purchase_order", "line_number", "qc_accepted_qty"}, ...]}
+    """
+    if isinstance(results, str):
+        results = json.loads(results)
+    try:
+        updated = apply_qc_accepted_qty(results)
+        frappe.db.commit()
+        return {"success": True, "updated": updated}
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), "update_qc_accepted_qty_batch")
+        return {"success": False, "error": str(e)}
+
+
+def apply_qc_accepted_qty(results):
+    """
+    以 qc_accepted_qty = qc_accepted_qty + n 原子累加，先以 SELECT ... FOR UPDATE 鎖定明細列，
+    同時送出的檢驗結果不會互相覆蓋。不 commit，由呼叫端決定。
+    """
+    # 同一行的多筆結果先合併
+    increments = {}
+    for result in results or []:
+        key = (result.get("purchase_order"), cint(result.get("line_number")))
+        if not key[0] or not key[1]:
+            frappe.throw(_("檢驗結果缺少 Purchase Order 或 Line：{0}").format(result))
+        increments[key] = increments.get(key, 0) + cint(result.get("aql_qty"))
+    if not increments:
+        frappe.throw(_("沒有要更新的檢驗結果。"))
+
+    for po_name in {po_name for po_name, _line in increments}:
+        if not frappe.has_permission("Purchase Order", "read", po_name):
+            frappe.throw(_("您沒有足夠的權限訪問採購訂單 {0}。").format(po_name), frappe.PermissionError)
+
+    # 依 name 排序鎖定，避免多個批次互相死鎖
+    conditions = " OR ".join(["(parent = %s AND line = %s)"] * len(increments))
+    values = [v for key in increments for v in key]
+    rows = frappe.db.sql(f"""
+        SELECT name, parent, line, IFNULL(qc_accepted_qty, 0) AS qc_accepted_qty
+        FROM `tabPurchase Order Item`
+        WHERE parenttype = 'Purchase Order' AND ({conditions})
+        ORDER BY name
+        FOR UPDATE
+    """, values, as_dict=True)
+
+    rows_by_key = {(row.parent, cint(row.line)): row for row in rows}
+    missing = [key for key in increments if key not in rows_by_key]
+    if missing:
+        frappe.throw(_("找不到採購訂單明細：{0}").format(
+            ", ".join(f"PO {po_name}, Line {line}" for po_name, line in missing)))
+
+    # 一次 UPDATE 所有明細
+    cases = " ".join(["WHEN %s THEN %s"] * len(increments))
+    case_values = []
+    for key, qty in increments.items():
+        case_values += [rows_by_key[key].name, qty]
+    names = [rows_by_key[key].name for key in increments]
+    frappe.db.sql(f"""
+        UPDATE `tabPurchase Order Item`
+        SET qc_accepted_qty = IFNULL(qc_accepted_qty, 0) + (CASE name {cases} ELSE 0 END),
+            modified = %s
+        WHERE name IN ({", ".join(["%s"] * len(names))})
+    """, case_values + [now()] + names)
+
+    refresh_po_qc_totals({po_name for po_name, _line in increments})
+
+    return [
+        {
+            "purchase_order": po_name,
+            "line_number": line,
+            "qc_accepted_qty": rows_by_key[(po_name, line)].qc_accepted_qty + qty,
+        }
+        for (po_name, line), qty in increments.items()
+    ]
+
+
+def refresh_po_qc_totals(po_names):
+    """重新加總各 PO 的 total_qc_accepted_qty（每張 PO 一次），並清除文件快取"""
+    po_names = list(po_names)
+    frappe.db.sql("""
+        UPDATE `tabPurchase Order` po
+        LEFT JOIN (
+            SELECT parent, SUM(IFNULL(qc_accepted_qty, 0)) AS qc_qty
+            FROM `tabPurchase Order Item`
+            WHERE parenttype = 'Purchase Order' AND parent IN %(po_names)s
+            GROUP BY parent
+        ) t ON t.parent = po.name
+        SET po.total_qc_accepted_qty = IFNULL(t.qc_qty, 0)
+        WHERE po.name IN %(po_names)s
+    """, {"po_names": tuple(po_names)})
+
+    for po_name in po_names:
+        frappe.clear_document_cache("Purchase Order", po_name)
\ No newline at end of file
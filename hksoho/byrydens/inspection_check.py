@@ -1,13 +1,14 @@
 import frappe
 from frappe.utils import getdate, today
 
+from hksoho.utils.trace import get_tracer
+
+tracer = get_tracer("inspection_check")
+
 def execute():
     current_date = getdate()  # 今天日期（date 物件）
 
-    frappe.log_error(
-        title="Inspection Event Scheduler",
-        message=f"Job started, current_date={current_date}"
-    )
+    tracer.info("Job started, current_date=%s", current_date)
 
     # 1. 找出所有 Open 的 Inspection Event
     events = frappe.get_all(
@@ -17,105 +18,116 @@ def execute():
     )
 
     if not events:
-        frappe.log_error(
-            title="Inspection Event Scheduler",
-            message="No open Inspection Event found"
-        )
+        tracer.info("No open Inspection Event found")
         return
 
-    frappe.log_error(
-        title="Inspection Event Scheduler",
-        message=f"Found {len(events)} open Inspection Event(s): {[e.name for e in events]}"
-    )
+    tracer.info("Found %s open Inspection Event(s)", len(events))
 
-    for ev in events:
-        ev_doc = frappe.get_doc("Inspection Event", ev.name)
+    # 所有 Open Event 的明細一次取出
+    lines_by_event = {ev.name: [] for ev in events}
+    for line in frappe.get_all(
+        "Inspection Line",
+        filters={"parenttype": "Inspection Event", "parent": ["in", list(lines_by_event)]},
+        fields=["name", "parent", "po_number", "po_item", "status"],
+        order_by="idx asc"
+    ):
+        lines_by_event[line.parent].append(line)
+
+    # 2. 一次查出所有候選 Inspection，在記憶體中比對 (supplier, po, line, date)
+    inspected = get_inspected_keys(events, lines_by_event, current_date)
 
+    updated_events = 0
+    for ev in events:
         # 使用 starts_on 的日期，沒有就用今天
-        event_date = getdate(ev_doc.starts_on) if ev_doc.starts_on else current_date
-
-        frappe.log_error(
-            title="Inspection Event Scheduler",
-            message=f"Processing Event {ev_doc.name}, supplier={ev_doc.supplier}, "
-                    f"starts_on={ev_doc.starts_on}, event_date={event_date}"
-        )
-
-        if not ev_doc.po_items:
-            frappe.log_error(
-                title="Inspection Event Scheduler",
-                message=f"Event {ev_doc.name} has no PO Items"
-            )
+        event_date = getdate(ev.starts_on) if ev.starts_on else current_date
+        lines = lines_by_event[ev.name]
+
+        tracer.debug("Processing Event %s, supplier=%s, starts_on=%s, event_date=%s",
+                     ev.name, ev.supplier, ev.starts_on, event_date)
+
+        if not lines:
+            tracer.debug("Event %s has no PO Items", ev.name)
             continue
 
         all_lines_completed = True
+        completed_lines = set()
 
-        for line in ev_doc.po_items:
-            frappe.log_error(
-                title="Inspection Event Scheduler",
-                message=f"  Line name={line.name}, po_number={line.po_number}, "
-                        f"po_item={line.po_item}, status={line.status}"
-            )
+        for line in lines:
+            tracer.debug("  Line name=%s, po_number=%s, po_item=%s, status=%s",
+                         line.name, line.po_number, line.po_item, line.status)
 
             # 已經 Completed 的就略過
             if line.status == "Completed":
                 continue
 
-            po_number = line.po_number
-            po_line = line.po_item
-
-            if not po_number or not po_line:
+            if not line.po_number or not line.po_item:
                 all_lines_completed = False
-                frappe.log_error(
-                    title="Inspection Event Scheduler",
-                    message=f"  Line {line.name} missing po_number or po_item, skip"
-                )
+                tracer.warning("  Line %s missing po_number or po_item, skip", line.name)
                 continue
 
-            # 2. 找對應 Inspection（同一天）
-            inspections = frappe.get_all(
-                "Inspection",
-                filters={
-                    "supplier": ev_doc.supplier,
-                    "purchase_order": po_number,
-                    "purchase_order_line": po_line,
-                    "inspection_date": event_date,
-                    # 如需更嚴謹，可加:
-                    # "result": ["!=", "NA"],
-                    # "docstatus": 1,
-                },
-                fields=["name", "result"]
-            )
-
-            if inspections:
-                line.status = "Completed"
-                frappe.log_error(
-                    title="Inspection Event Scheduler",
-                    message=f"  Line {line.name} marked Completed, "
-                            f"found Inspections: {[i.name for i in inspections]}"
-                )
+            key = (ev.supplier, line.po_number, str(line.po_item), event_date)
+            if key in inspected:
+                completed_lines.add(line.name)
+                tracer.debug("  Line %s marked Completed, found Inspections: %s", line.name, inspected[key])
             else:
                 all_lines_completed = False
-                frappe.log_error(
-                    title="Inspection Event Scheduler",
-                    message=f"  Line {line.name} still Scheduled, "
-                            f"no Inspection found on {event_date}"
-                )
+                tracer.debug("  Line %s still Scheduled, no Inspection found on %s", line.name, event_date)
 
-        # 儲存子表狀態
-        ev_doc.save(ignore_permissions=True)
+        # 沒有任何變動的 Event 不寫入
+        if not completed_lines and not all_lines_completed:
+            continue
+
+        ev_doc = frappe.get_doc("Inspection Event", ev.name)
+        for line in ev_doc.po_items:
+            if line.name in completed_lines:
+                line.status = "Completed"
 
         # 3. 如果所有行都 Completed，更新 Event 狀態
         if all_lines_completed and ev_doc.status != "Completed":
             old_status = ev_doc.status
             ev_doc.status = "Completed"
-            ev_doc.save(ignore_permissions=True)
-            frappe.log_error(
-                title="Inspection Event Scheduler",
-                message=f"Event {ev_doc.name} status changed {old_status} -> Completed"
-            )
+            tracer.info("Event %s status changed %s -> Completed", ev_doc.name, old_status)
+
+        ev_doc.save(ignore_permissions=True)
+        updated_events += 1
 
     frappe.db.commit()
-    frappe.log_error(
-        title="Inspection Event Scheduler",
-        message="Job finished"
+    tracer.info("Job finished, %s Inspection Event(s) updated", updated_events)
+
+
+def get_inspected_keys(events, lines_by_event, current_date):
+    """
+    一次查詢所有候選 Inspection。
+    回傳 {(supplier, purchase_order, purchase_order_line, inspection_date): [inspection names]}
+    """
+    keys = set()
+    for ev in events:
+        event_date = getdate(ev.starts_on) if ev.starts_on else current_date
+        for line in lines_by_event[ev.name]:
+            if line.status != "Completed" and line.po_number and line.po_item:
+                keys.add((ev.supplier, line.po_number, str(line.po_item), event_date))
+
+    if not keys:
+        return {}
+
+    # 先用各欄位的 IN 條件縮小範圍，再於記憶體中比對完整的 key
+    inspections = frappe.get_all(
+        "Inspection",
+        filters={
+            "supplier": ["in", list({k[0] for k in keys})],
+            "purchase_order": ["in", list({k[1] for k in keys})],
+            "purchase_order_line": ["in", list({k[2] for k in keys})],
+            "inspection_date": ["in", list({k[3] for k in keys})],
+            # 如需更嚴謹，可加:
+            # "result": ["!=", "NA"],
+            # "docstatus": 1,
+        },
+        fields=["name", "supplier", "purchase_order", "purchase_order_line", "inspection_date"]
     )
+
+    inspected = {}
+    for insp in inspections:
+        key = (insp.supplier, insp.purchase_order, str(insp.purchase_order_line), getdate(insp.inspection_date))
+        if key in keys:
+            inspected.setdefault(key, []).append(insp.name)
+    return inspected
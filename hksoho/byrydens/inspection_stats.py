@@ -0,0 +1,344 @@
+"""
+檢驗品質統計（Inspection Quality Stat / Inspection Defect Stat）
+
+依 (來源, supplier, article_number, 月份) 預先彙總的檢驗結果：
+- Inspection 存檔 / 刪除時增量更新（先扣除舊內容，再加上新內容）
+- xpin 歷史資料（xpin_order_item_inspections / xpin_inspection_data）以 INSERT ... SELECT 一次回填
+- get_inspection_quality_stats / get_inspection_defect_stats 供儀表板查詢
+"""
+
+import hashlib
+
+import frappe
+from frappe.utils import cint, getdate, now
+
+QUALITY_STAT_FIELDS = (
+    "inspections", "passed", "failed", "not_applicable",
+    "inspected_qty", "failed_qty", "aql_qty", "defects",
+)
+RESULT_TABLES = (
+    "inspection_results", "inspection_results_construction",
+    "inspection_results_product", "inspection_results_shade",
+)
+GROUP_BY_FIELDS = {
+    "supplier": ["supplier"],
+    "article": ["article_number"],
+    "period": ["period"],
+    "supplier_period": ["supplier", "period"],
+    "supplier_article": ["supplier", "article_number"],
+}
+
+
+def get_stat_name(*key):
+    """統計列的 name：key 的 MD5，SQL 端以 MD5(CONCAT_WS('|', ...)) 產生相同的值"""
+    return hashlib.md5("|".join(str(k or "") for k in key).encode()).hexdigest()
+
+
+def get_inspection_contribution(doc):
+    """
+    回傳單一 Inspection 對統計的貢獻：
+    (stat_key, {field: value}, {defect_code: count})，stat_key = (supplier, article_number, period)，
+    空的 supplier / article_number / defect_code 以 '' 表示
+    """
+    inspection_date = getdate(doc.inspection_date or doc.creation)
+    # 空值一律存成 ''，與重建 SQL 的 IFNULL(..., '') 一致
+    stat_key = (doc.supplier or "", doc.article_number or "", inspection_date.strftime("%Y-%m"))
+
+    defects = {}
+    for table in RESULT_TABLES:
+        for row in doc.get(table) or []:
+            if row.result == "Fail":
+                code = row.item_number or row.description or row.category or ""
+                defects[code] = defects.get(code, 0) + 1
+
+    values = {
+        "inspections": 1,
+        "passed": 1 if doc.result == "Pass" else 0,
+        "failed": 1 if doc.result == "Failure" else 0,
+        "not_applicable": 1 if doc.result not in ("Pass", "Failure") else 0,
+        "inspected_qty": cint(doc.inspected_qty),
+        "failed_qty": cint(doc.failed_qty),
+        "aql_qty": cint(doc.aql_qty),
+        "defects": sum(defects.values()),
+    }
+    return stat_key, values, defects
+
+
+def update_inspection_stats(doc, previous=None, deleted=False):
+    """Inspection 存檔 / 刪除時呼叫：扣除 previous 的貢獻，加上 doc 的貢獻"""
+    changes = []
+    if previous:
+        changes.append((get_inspection_contribution(previous), -1))
+    if doc and not deleted:
+        changes.append((get_inspection_contribution(doc), 1))
+
+    # 內容沒有變化（例如只改備註）時不寫入
+    if len(changes) == 2 and changes[0][0] == changes[1][0]:
+        return
+
+    for (stat_key, values, defects), sign in changes:
+        _upsert_quality_stat(stat_key, {f: sign * v for f, v in values.items()})
+        for code, count in defects.items():
+            _upsert_defect_stat(stat_key, code, sign * count)
+
+
+def _upsert_quality_stat(stat_key, values):
+    supplier, article_number, period = stat_key
+    timestamp = now()
+    frappe.db.sql("""
+        INSERT INTO `tabInspection Quality Stat`
+            (name, creation, modified, owner, modified_by, source, supplier, article_number,
+             period, year, month, {fields})
+        VALUES
+            (%(name)s, %(now)s, %(now)s, 'Administrator', 'Administrator', 'Inspection', %(supplier)s,
+             %(article_number)s, %(period)s, %(year)s, %(month)s, {placeholders})
+        ON DUPLICATE KEY UPDATE modified = %(now)s, {updates}
+    """.format(
+        fields=", ".join(QUALITY_STAT_FIELDS),
+        placeholders=", ".join(f"%({f})s" for f in QUALITY_STAT_FIELDS),
+        updates=", ".join(f"{f} = {f} + VALUES({f})" for f in QUALITY_STAT_FIELDS),
+    ), {
+        "name": get_stat_name("Inspection", supplier, article_number, period),
+        "now": timestamp,
+        "supplier": supplier,
+        "article_number": article_number,
+        "period": period,
+        "year": cint(period[:4]),
+        "month": cint(period[5:]),
+        **values,
+    })
+
+
+def _upsert_defect_stat(stat_key, defect_code, count):
+    supplier, article_number, period = stat_key
+    timestamp = now()
+    frappe.db.sql("""
+        INSERT INTO `tabInspection Defect Stat`
+            (name, creation, modified, owner, modified_by, source, supplier, article_number,
+             period, defect_code, defects)
+        VALUES
+            (%(name)s, %(now)s, %(now)s, 'Administrator', 'Administrator', 'Inspection', %(supplier)s,
+             %(article_number)s, %(period)s, %(defect_code)s, %(defects)s)
+        ON DUPLICATE KEY UPDATE modified = %(now)s, defects = defects + VALUES(defects)
+    """, {
+        "name": get_stat_name("Inspection", supplier, article_number, period, defect_code),
+        "now": timestamp,
+        "supplier": supplier,
+        "article_number": article_number,
+        "period": period,
+        "defect_code": defect_code,
+        "defects": count,
+    })
+
+
+@frappe.whitelist()
+def rebuild_inspection_stats(source="xpin"):
+    """
+    重建指定來源的統計（System Manager）。xpin 歷史資料量大，放到 long queue 執行。
+    source: "xpin" 或 "Inspection"
+    """
+    frappe.only_for("System Manager")
+    if source not in ("xpin", "Inspection"):
+        frappe.throw(f"Unknown inspection stats source: {source}")
+
+    frappe.enqueue(
+        "hksoho.byrydens.inspection_stats.rebuild_inspection_stats_job",
+        queue="long",
+        timeout=3600,
+        job_id=f"rebuild_inspection_stats_{source}",
+        deduplicate=True,
+        source=source,
+    )
+    return {"status": "queued", "source": source}
+
+
+def rebuild_inspection_stats_job(source):
+    """刪除該來源的統計後，以 INSERT ... SELECT 一次回填"""
+    logger = frappe.logger("inspection_stats")
+    values = {"source": source, "now": now()}
+
+    frappe.db.sql("DELETE FROM `tabInspection Quality Stat` WHERE source = %(source)s", values)
+    frappe.db.sql("DELETE FROM `tabInspection Defect Stat` WHERE source = %(source)s", values)
+
+    if source == "xpin":
+        frappe.db.sql(XPIN_QUALITY_STAT_SQL, values)
+        frappe.db.sql(XPIN_DEFECT_STAT_SQL, values)
+    else:
+        frappe.db.sql(INSPECTION_QUALITY_STAT_SQL, values)
+        frappe.db.sql(INSPECTION_DEFECT_STAT_SQL, values)
+
+    # 每組的 defects 合計由 Defect Stat 回寫
+    frappe.db.sql("""
+        UPDATE `tabInspection Quality Stat` q
+        JOIN (
+            SELECT supplier, article_number, period, SUM(defects) AS defects
+            FROM `tabInspection Defect Stat`
+            WHERE source = %(source)s
+            GROUP BY supplier, article_number, period
+        ) d ON d.supplier <=> q.supplier AND d.article_number <=> q.article_number AND d.period = q.period
+        SET q.defects = d.defects
+        WHERE q.source = %(source)s
+    """, values)
+
+    frappe.db.commit()
+    logger.info(f"Rebuilt inspection stats for source {source}")
+
+
+# 歷史資料：每筆 xpin_order_item_inspections 為一次檢驗，supplier / article 由訂單明細帶出
+XPIN_INSPECTION_JOIN = """
+    FROM `tabxpin_order_item_inspections` i
+    LEFT JOIN `tabxpin_order_items` oi ON oi.name = i.itemid
+    LEFT JOIN `tabxpin_orders` o ON o.name = oi.ordernr
+"""
+
+XPIN_QUALITY_STAT_SQL = """
+    INSERT INTO `tabInspection Quality Stat`
+        (name, creation, modified, owner, modified_by, source, supplier, article_number,
+         period, year, month, inspections, passed, failed, not_applicable,
+         inspected_qty, failed_qty, aql_qty, defects)
+    SELECT
+        MD5(CONCAT_WS('|', 'xpin', IFNULL(o.supplierid, ''), IFNULL(oi.artnr, ''),
+                      DATE_FORMAT(i.inspectiondate, '%%Y-%%m'))),
+        %(now)s, %(now)s, 'Administrator', 'Administrator', 'xpin',
+        IFNULL(o.supplierid, ''), IFNULL(oi.artnr, ''), DATE_FORMAT(i.inspectiondate, '%%Y-%%m'),
+        YEAR(i.inspectiondate), MONTH(i.inspectiondate),
+        COUNT(*),
+        SUM(IFNULL(r.passed, 0) = 1 AND r.name IS NOT NULL),
+        SUM(IFNULL(r.passed, 0) = 0 AND r.name IS NOT NULL),
+        SUM(r.name IS NULL),
+        SUM(IFNULL(i.qtyinspected, 0)), SUM(IFNULL(i.qtyfailed, 0)), SUM(IFNULL(i.aql, 0)),
+        0
+    """ + XPIN_INSPECTION_JOIN + """
+    LEFT JOIN `tabxpin_inspection_results` r ON r.name = i.result
+    WHERE i.inspectiondate IS NOT NULL
+    GROUP BY IFNULL(o.supplierid, ''), IFNULL(oi.artnr, ''), DATE_FORMAT(i.inspectiondate, '%%Y-%%m')
+"""
+
+# 歷史資料的缺點：xpin_inspection_data 中 errorcode > 0 的檢查項目
+XPIN_DEFECT_STAT_SQL = """
+    INSERT INTO `tabInspection Defect Stat`
+        (name, creation, modified, owner, modified_by, source, supplier, article_number,
+         period, defect_code, defects)
+    SELECT
+        MD5(CONCAT_WS('|', 'xpin', IFNULL(o.supplierid, ''), IFNULL(oi.artnr, ''),
+                      DATE_FORMAT(i.inspectiondate, '%%Y-%%m'), d.errorcode)),
+        %(now)s, %(now)s, 'Administrator', 'Administrator', 'xpin',
+        IFNULL(o.supplierid, ''), IFNULL(oi.artnr, ''), DATE_FORMAT(i.inspectiondate, '%%Y-%%m'),
+        d.errorcode, COUNT(*)
+    FROM `tabxpin_inspection_data` d
+    JOIN `tabxpin_order_item_inspections` i ON i.name = d.inspectionid
+    LEFT JOIN `tabxpin_order_items` oi ON oi.name = i.itemid
+    LEFT JOIN `tabxpin_orders` o ON o.name = oi.ordernr
+    WHERE IFNULL(d.errorcode, 0) > 0
+      AND i.inspectiondate IS NOT NULL
+    GROUP BY IFNULL(o.supplierid, ''), IFNULL(oi.artnr, ''), DATE_FORMAT(i.inspectiondate, '%%Y-%%m'), d.errorcode
+"""
+
+INSPECTION_QUALITY_STAT_SQL = """
+    INSERT INTO `tabInspection Quality Stat`
+        (name, creation, modified, owner, modified_by, source, supplier, article_number,
+         period, year, month, inspections, passed, failed, not_applicable,
+         inspected_qty, failed_qty, aql_qty, defects)
+    SELECT
+        MD5(CONCAT_WS('|', 'Inspection', IFNULL(supplier, ''), IFNULL(article_number, ''),
+                      DATE_FORMAT(IFNULL(inspection_date, creation), '%%Y-%%m'))),
+        %(now)s, %(now)s, 'Administrator', 'Administrator', 'Inspection',
+        IFNULL(supplier, ''), IFNULL(article_number, ''), DATE_FORMAT(IFNULL(inspection_date, creation), '%%Y-%%m'),
+        YEAR(IFNULL(inspection_date, creation)), MONTH(IFNULL(inspection_date, creation)),
+        COUNT(*),
+        SUM(result = 'Pass'), SUM(result = 'Failure'), SUM(IFNULL(result, '') NOT IN ('Pass', 'Failure')),
+        SUM(IFNULL(inspected_qty, 0)), SUM(IFNULL(failed_qty, 0)), SUM(IFNULL(aql_qty, 0)),
+        0
+    FROM `tabInspection`
+    GROUP BY IFNULL(supplier, ''), IFNULL(article_number, ''), DATE_FORMAT(IFNULL(inspection_date, creation), '%%Y-%%m')
+"""
+
+INSPECTION_DEFECT_STAT_SQL = """
+    INSERT INTO `tabInspection Defect Stat`
+        (name, creation, modified, owner, modified_by, source, supplier, article_number,
+         period, defect_code, defects)
+    SELECT
+        MD5(CONCAT_WS('|', 'Inspection', IFNULL(insp.supplier, ''), IFNULL(insp.article_number, ''),
+                      DATE_FORMAT(IFNULL(insp.inspection_date, insp.creation), '%%Y-%%m'),
+                      IFNULL(COALESCE(NULLIF(res.item_number, ''), NULLIF(res.description, ''), res.category), ''))),
+        %(now)s, %(now)s, 'Administrator', 'Administrator', 'Inspection',
+        IFNULL(insp.supplier, ''), IFNULL(insp.article_number, ''),
+        DATE_FORMAT(IFNULL(insp.inspection_date, insp.creation), '%%Y-%%m'),
+        IFNULL(COALESCE(NULLIF(res.item_number, ''), NULLIF(res.description, ''), res.category), ''), COUNT(*)
+    FROM `tabInspection Result` res
+    JOIN `tabInspection` insp ON insp.name = res.parent AND res.parenttype = 'Inspection'
+    WHERE res.result = 'Fail'
+    GROUP BY IFNULL(insp.supplier, ''), IFNULL(insp.article_number, ''),
+             DATE_FORMAT(IFNULL(insp.inspection_date, insp.creation), '%%Y-%%m'),
+             IFNULL(COALESCE(NULLIF(res.item_number, ''), NULLIF(res.description, ''), res.category), '')
+"""
+
+
+def _get_stat_conditions(supplier=None, article_number=None, from_period=None, to_period=None, source=None):
+    conditions = []
+    values = {}
+    for fieldname, value in (("supplier", supplier), ("article_number", article_number), ("source", source)):
+        if value:
+            conditions.append(f"{fieldname} = %({fieldname})s")
+            values[fieldname] = value
+    if from_period:
+        conditions.append("period >= %(from_period)s")
+        values["from_period"] = from_period
+    if to_period:
+        conditions.append("period <= %(to_period)s")
+        values["to_period"] = to_period
+    return ("WHERE " + " AND ".join(conditions)) if conditions else "", values
+
+
+@frappe.whitelist()
+def get_inspection_quality_stats(supplier=None, article_number=None, from_period=None, to_period=None,
+                                 group_by="supplier", source=None):
+    """
+    Pass / fail rates and quantities from the pre-aggregated stats table.
+
+    Args:
+        supplier, article_number, source: optional filters
+        from_period, to_period: "YYYY-MM" range (inclusive)
+        group_by: supplier / article / period / supplier_period / supplier_article
+    Returns:
+        list of dicts with the group fields, the summed counters and pass_rate / failed_qty_rate (%)
+    """
+    if not frappe.has_permission("Inspection Quality Stat", "read"):
+        frappe.throw("You do not have sufficient permissions to access inspection statistics.", frappe.PermissionError)
+    if group_by not in GROUP_BY_FIELDS:
+        frappe.throw(f"Unsupported group_by: {group_by}")
+
+    group_fields = ", ".join(GROUP_BY_FIELDS[group_by])
+    where, values = _get_stat_conditions(supplier, article_number, from_period, to_period, source)
+    rows = frappe.db.sql(f"""
+        SELECT {group_fields}, {", ".join(f"SUM({f}) AS {f}" for f in QUALITY_STAT_FIELDS)}
+        FROM `tabInspection Quality Stat`
+        {where}
+        GROUP BY {group_fields}
+        ORDER BY {group_fields}
+    """, values, as_dict=True)
+
+    for row in rows:
+        judged = (row.passed or 0) + (row.failed or 0)
+        row.pass_rate = round(row.passed * 100.0 / judged, 2) if judged else None
+        row.failed_qty_rate = round(row.failed_qty * 100.0 / row.inspected_qty, 2) if row.inspected_qty else None
+    return rows
+
+
+@frappe.whitelist()
+def get_inspection_defect_stats(supplier=None, article_number=None, from_period=None, to_period=None,
+                                source=None, limit=20):
+    """最常見的缺點代碼（依次數排序）"""
+    if not frappe.has_permission("Inspection Defect Stat", "read"):
+        frappe.throw("You do not have sufficient permissions to access inspection statistics.", frappe.PermissionError)
+
+    where, values = _get_stat_conditions(supplier, article_number, from_period, to_period, source)
+    values["limit"] = cint(limit) or 20
+    return frappe.db.sql(f"""
+        SELECT defect_code, SUM(defects) AS defects
+        FROM `tabInspection Defect Stat`
+        {where}
+        GROUP BY defect_code
+        ORDER BY defects DESC
+        LIMIT %(limit)s
+    """, values, as_dict=True)
@@ -0,0 +1,165 @@
+from bisect import bisect_right
+
+import frappe
+from frappe.utils import flt, getdate, now, today
+
+BASE_CURRENCY = "SEK"
+# 換算 SEK 的匯率日期：PO 的 ship date 或今天
+RATE_BASIS_SHIP_DATE = "Ship Date"
+RATE_BASIS_TODAY = "Today"
+
+# Orders Due to Pay 的彙總表：每張 PO 一列（PO 只有一個 ship date 與幣別，
+# 因此 (year, month, PO, currency) 以 PO 為唯一鍵），只保留尚有未出貨金額的 PO
+DUE_SUMMARY_SQL = """
+    INSERT INTO `tabPO Due Summary`
+        (name, creation, modified, owner, modified_by, docstatus, idx,
+         purchase_order, supplier, po_shipdate, po_status, year, month, currency, due_amount)
+    SELECT
+        po.name, %(now)s, %(now)s, 'Administrator', 'Administrator', 0, 0,
+        po.name, po.supplier, po.po_shipdate, po.po_status,
+        YEAR(po.po_shipdate), MONTH(po.po_shipdate), po.order_purchase_currency,
+        SUM((item.confirmed_qty - COALESCE(item.booked_qty, 0)) * item.unit_price) AS due_amount
+    FROM `tabPurchase Order` po
+    JOIN `tabPurchase Order Item` item ON item.parent = po.name AND item.parenttype = 'Purchase Order'
+    WHERE po.po_shipdate IS NOT NULL
+      AND item.confirmed_qty > COALESCE(item.booked_qty, 0)
+      AND item.confirmed_qty > 0
+      AND item.unit_price > 0
+      {condition}
+    GROUP BY po.name
+    HAVING due_amount > 0
+"""
+
+
+def update_po_due_summary(po_names):
+    """重新計算指定 PO 的彙總列（PO 存檔 / 刪除時呼叫）"""
+    po_names = tuple({p for p in po_names if p})
+    if not po_names:
+        return
+
+    values = {"po_names": po_names, "now": now()}
+    frappe.db.sql("DELETE FROM `tabPO Due Summary` WHERE name IN %(po_names)s", values)
+    frappe.db.sql(DUE_SUMMARY_SQL.format(condition="AND po.name IN %(po_names)s"), values)
+
+
+@frappe.whitelist()
+def rebuild_po_due_summary():
+    """重建整個 Orders Due to Pay 彙總表（System Manager，背景執行）"""
+    frappe.only_for("System Manager")
+    enqueue_po_due_summary_rebuild()
+    return {"status": "queued"}
+
+
+def enqueue_po_due_summary_rebuild():
+    frappe.enqueue(
+        "hksoho.byrydens.orders_due_api.rebuild_po_due_summary_job",
+        queue="long",
+        job_id="rebuild_po_due_summary",
+        deduplicate=True,
+        enqueue_after_commit=True,
+    )
+
+
+def rebuild_po_due_summary_job():
+    """bench --site <site> execute hksoho.byrydens.orders_due_api.rebuild_po_due_summary_job"""
+    frappe.db.sql("DELETE FROM `tabPO Due Summary`")
+    frappe.db.sql(DUE_SUMMARY_SQL.format(condition=""), {"now": now()})
+    frappe.db.commit()
+    frappe.logger("orders_due_to_pay").info("Rebuilt PO Due Summary")
+
+
+def get_monthly_due_amounts(rate_basis=RATE_BASIS_SHIP_DATE):
+    """
+    每月的未出貨金額（由彙總表讀取）。
+    回傳 [{year, month_num, amounts: {currency: 原幣金額}, due_amount_sek, missing_rates}]
+    """
+    group_by_date = rate_basis != RATE_BASIS_TODAY
+    date_field = "po_shipdate" if group_by_date else "NULL AS po_shipdate"
+    group_date = ", po_shipdate" if group_by_date else ""
+
+    # 依 (月份, 幣別[, ship date]) 彙總，再一次換算成 SEK
+    rows = frappe.db.sql(f"""
+        SELECT year, month AS month_num, currency, {date_field}, SUM(due_amount) AS due_amount
+        FROM `tabPO Due Summary`
+        GROUP BY year, month, currency{group_date}
+        ORDER BY year ASC, month_num ASC
+    """, as_dict=1)
+    convert_to_sek(rows, "due_amount", rate_basis)
+
+    months = {}
+    for row in rows:
+        month = months.setdefault((row.year, row.month_num), frappe._dict(
+            year=row.year, month_num=row.month_num, amounts={}, due_amount_sek=0, missing_rates=set()
+        ))
+        currency = row.currency or ""
+        month.amounts[currency] = month.amounts.get(currency, 0) + flt(row.due_amount)
+        if row.sek_rate is None:
+            month.missing_rates.add(currency)
+        else:
+            month.due_amount_sek += row.due_amount_sek
+
+    return [m for m in months.values() if any(v > 0 for v in m.amounts.values())]
+
+
+def get_due_pos(year, month, rate_basis=RATE_BASIS_SHIP_DATE):
+    """指定月份的各 PO 未出貨金額及 SEK 換算（由彙總表讀取）"""
+    data = frappe.db.sql("""
+        SELECT
+            s.purchase_order AS po_number,
+            s.supplier AS partner_id,
+            COALESCE(p.partner_name, s.supplier, 'Unknown') AS partner_name,
+            s.po_shipdate,
+            s.po_status,
+            s.currency,
+            s.due_amount AS undelivered_value
+        FROM `tabPO Due Summary` s
+        LEFT JOIN `tabPartner` p ON p.partner_id = s.supplier
+        WHERE s.year = %(year)s AND s.month = %(month)s
+        ORDER BY s.po_shipdate DESC, s.purchase_order DESC
+    """, {"year": year, "month": month}, as_dict=1)
+    convert_to_sek(data, "undelivered_value", rate_basis)
+    return data
+
+
+def convert_to_sek(rows, amount_field, rate_basis=RATE_BASIS_SHIP_DATE):
+    """
+    一次載入相關幣別的所有匯率，在記憶體中換算每一列。
+    設定 row.sek_rate（找不到匯率時為 None）及 row.<amount_field>_sek。
+    """
+    rate_table = get_rate_table({row.currency for row in rows})
+    as_of = getdate(today())
+    for row in rows:
+        rate_date = getdate(row.po_shipdate) if rate_basis != RATE_BASIS_TODAY and row.po_shipdate else as_of
+        row.sek_rate = get_sek_rate(rate_table, row.currency, rate_date)
+        row[f"{amount_field}_sek"] = flt(flt(row[amount_field]) * row.sek_rate, 2) if row.sek_rate else 0
+    return rows
+
+
+def get_rate_table(currencies):
+    """回傳 {code: ([rate_date...], [rate...])}，依日期排序，供 get_sek_rate 二分搜尋"""
+    currencies = [c for c in currencies if c and c != BASE_CURRENCY]
+    rate_table = {}
+    if not currencies:
+        return rate_table
+
+    for code, rate, rate_date in frappe.get_all(
+        "Currency Rate",
+        filters={"code": ["in", currencies], "rate": [">", 0], "rate_date": ["is", "set"]},
+        fields=["code", "rate", "rate_date"],
+        order_by="code asc, rate_date asc",
+        as_list=True,
+    ):
+        dates, rates = rate_table.setdefault(code, ([], []))
+        dates.append(getdate(rate_date))
+        rates.append(flt(rate))
+    return rate_table
+
+
+def get_sek_rate(rate_table, currency, rate_date):
+    """rate_date 當天或之前最近的匯率；日期早於所有匯率時使用最早的一筆"""
+    if currency == BASE_CURRENCY:
+        return 1
+    if currency not in rate_table:
+        return None
+    dates, rates = rate_table[currency]
+    return rates[max(bisect_right(dates, rate_date) - 1, 0)]
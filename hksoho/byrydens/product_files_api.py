@@ -1,50 +1,29 @@
 import frappe
 from frappe import _
+from frappe.utils import escape_html
+from urllib.parse import quote
+
+from hksoho.utils.trace import get_tracer
+
+# Product Attachment Link 的 autoname（PAL-.#####）
+PRODUCT_ATTACHMENT_LINK_SERIES = "PAL-"
+PRODUCT_ATTACHMENT_LINK_DIGITS = 5
+
+tracer = get_tracer("product_files_api")
+
+# 每個 Product 的附件 HTML 快取（Redis hash: product -> html）
+PRODUCT_ATTACHMENTS_CACHE_KEY = "hksoho:product_attachments_html"
+
 
 @frappe.whitelist()
 def get_product_attachments(product_name):
     try:
-        # Debug: Log input
-        frappe.log_error(message=f"Fetching attachments for product: {product_name}", title="Product Attachment Debug")
-
-        # Check user permission
-        has_permission = frappe.has_permission('Product Attachment Link', 'read')
-        frappe.log_error(message=f"User permission for Product Attachment Link: {has_permission}", title="Product Attachment Debug")
-
-        # Fetch associated attachment links
-        links = frappe.get_all('Product Attachment Link', 
-                              filters={'product': product_name},
-                              fields=['parent'])
-        frappe.log_error(message=f"Found {len(links)} links", title="Product Attachment Debug")
-
-        if not links:
-            return {'html': '<p>No associated attachments</p>'}
-
-        attachment_names = [link['parent'] for link in links]
-        frappe.log_error(message=f"Attachment Names: {attachment_names}", title="Product Attachment Debug")
-
-        # Validate attachment names
-        valid_attachments = frappe.get_all('Product Attachment',
-                                          filters={'name': ['in', attachment_names],'active': 1},
-                                          fields=['name'])
-        valid_names = [att['name'] for att in valid_attachments]
-        frappe.log_error(message=f"Valid Attachment Names: {valid_names}", title="Product Attachment Debug")
-
-        # Fetch attachment details for valid names only
-        attachments = frappe.get_all('Product Attachment',
-                                   filters={'name': ['in', valid_names],'active': 1},
-                                   fields=['name', 'attachment_name', 'file_type', 'attachment_file'])
-        frappe.log_error(message=f"Found {len(attachments)} attachments", title="Product Attachment Debug")
-
-        # Generate HTML table
-        html = '<table class="table table-bordered">'
-        html += '<thead><tr><th>File Name</th><th>Type</th><th>Download</th></tr></thead>'
-        html += '<tbody>'
-        for attachment in attachments:
-            attachment_url = f'/app/product-attachment/{attachment["name"]}'
-            html += f'<tr><td><a href="{attachment_url}" target="_blank">{attachment.attachment_name}</a></td><td>{attachment.file_type}</td><td><a href="{attachment.attachment_file}" target="_blank">Download</a></td></tr>'
-        
-        html += '</tbody></table>'
+        html = frappe.cache().hget(PRODUCT_ATTACHMENTS_CACHE_KEY, product_name)
+        if html is None:
+            html = render_product_attachments(product_name)
+            frappe.cache().hset(PRODUCT_ATTACHMENTS_CACHE_KEY, product_name, html)
+        else:
+            tracer.debug("Attachments HTML for product %s served from cache", product_name)
 
         return {'html': html}
 
@@ -52,6 +31,45 @@ def get_product_attachments(product_name):
         frappe.log_error(message=frappe.get_traceback(), title="Product Attachment Error")
         return {'html': '<p>Error loading attachments</p>'}
 
+
+def render_product_attachments(product_name):
+    """以一次 JOIN 查詢取得 Product 的有效附件並產生 HTML 表格"""
+    attachments = frappe.db.sql("""
+        SELECT DISTINCT pa.name, pa.attachment_name, pa.file_type, pa.attachment_file, pa.modified
+        FROM `tabProduct Attachment Link` link
+        JOIN `tabProduct Attachment` pa ON pa.name = link.parent
+        WHERE link.product = %(product)s
+          AND link.parenttype = 'Product Attachment'
+          AND pa.active = 1
+        ORDER BY pa.modified DESC
+    """, {"product": product_name}, as_dict=True)
+    tracer.debug("Found %s attachments for product %s", len(attachments), product_name)
+
+    if not attachments:
+        return '<p>No associated attachments</p>'
+
+    rows = "".join(
+        f'<tr><td><a href="/app/product-attachment/{quote(attachment.name)}" target="_blank">{escape_html(attachment.attachment_name or "")}</a></td>'
+        f'<td>{escape_html(attachment.file_type or "")}</td>'
+        f'<td><a href="{escape_html(attachment.attachment_file or "")}" target="_blank">Download</a></td></tr>'
+        for attachment in attachments
+    )
+    return (
+        '<table class="table table-bordered">'
+        '<thead><tr><th>File Name</th><th>Type</th><th>Download</th></tr></thead>'
+        f'<tbody>{rows}</tbody></table>'
+    )
+
+
+def clear_product_attachments_cache(products=None):
+    """清除指定 Product（或全部）的附件 HTML 快取"""
+    if products is None:
+        frappe.cache().delete_key(PRODUCT_ATTACHMENTS_CACHE_KEY)
+        return
+    for product in set(products):
+        if product:
+            frappe.cache().hdel(PRODUCT_ATTACHMENTS_CACHE_KEY, product)
+
 @frappe.whitelist()
 def link_attachments_to_products(file_docs, products):
     try:
@@ -69,7 +87,14 @@ def link_attachments_to_products(file_docs, products):
             frappe.throw(_('無產品列表或格式錯誤，檔案必須關聯至少一個產品'))
 
         # 除錯：記錄輸入（短 title，長 message）
-        frappe.log_error("Product Attachment Debug", f"Received {len(file_docs)} files and {len(products)} products. Raw file_docs: {file_docs}")
+        tracer.debug("Received %s files and %s products. Raw file_docs: %s", len(file_docs), len(products), file_docs)
+
+        # 一次驗證所有產品
+        products = list(dict.fromkeys(products))
+        existing_products = set(frappe.get_all("Product", filters={"name": ["in", products]}, pluck="name"))
+        missing_products = [product for product in products if product not in existing_products]
+        if missing_products:
+            frappe.throw(_('產品 {} 不存在').format(", ".join(missing_products)))
 
         for file_doc in file_docs:
             # 驗證 file_doc 是字典
@@ -82,11 +107,17 @@ def link_attachments_to_products(file_docs, products):
             if not file_doc.get('file_name'):
                 file_doc['file_name'] = 'Unknown'
 
-            # 檢查檔案是否在 File DocType 中
-            if not frappe.db.exists('File', {'file_url': file_doc.get('file_url')}):
-                frappe.throw(_('檔案未在 File DocType 中找到：{}').format(file_doc.get('file_url')))
+        # 一次檢查所有檔案是否在 File DocType 中
+        file_urls = list({file_doc['file_url'] for file_doc in file_docs})
+        existing_urls = set(frappe.get_all("File", filters={"file_url": ["in", file_urls]}, pluck="file_url"))
+        for file_url in file_urls:
+            if file_url not in existing_urls:
+                frappe.throw(_('檔案未在 File DocType 中找到：{}').format(file_url))
 
-            # 創建 Product Attachment
+        # 每個檔案建立一筆 Product Attachment，產品連結之後一次批次寫入
+        timestamp = frappe.utils.now()
+        link_rows = []
+        for file_doc in file_docs:
             attachment_doc = frappe.get_doc({
                 "doctype": "Product Attachment",
                 "attachment_name": file_doc.get('file_name'),
@@ -98,17 +129,33 @@ def link_attachments_to_products(file_docs, products):
             })
             attachment_doc.insert(ignore_permissions=True)
 
-            # 關聯產品
-            for product in products:
-                if not frappe.db.exists("Product", product):
-                    frappe.throw(_('產品 {} 不存在').format(product))
-                product_doc = frappe.get_doc("Product", product)
-                product_doc.append("attachments", {
-                    "product": product,
-                    "attachment": attachment_doc.name,
-                    "is_primary": 0
-                })
-                product_doc.save(ignore_permissions=True)
+            for idx, product in enumerate(products, start=1):
+                link_rows.append([
+                    timestamp, timestamp,
+                    frappe.session.user, frappe.session.user, 0, idx,
+                    attachment_doc.name, "Product Attachment", "product_link", product
+                ])
+
+        # name 依 Product Attachment Link 的 naming series（PAL-.#####）一次保留
+        for name, row in zip(reserve_series_names(PRODUCT_ATTACHMENT_LINK_SERIES, len(link_rows)), link_rows):
+            row.insert(0, name)
+
+        frappe.db.bulk_insert(
+            "Product Attachment Link",
+            fields=["name", "creation", "modified", "owner", "modified_by", "docstatus", "idx",
+                    "parent", "parenttype", "parentfield", "product"],
+            values=link_rows
+        )
+
+        # 每個 Product 只更新一次 modified，並清除附件 HTML 快取
+        frappe.db.sql("""
+            UPDATE `tabProduct`
+            SET modified = %(now)s, modified_by = %(user)s
+            WHERE name IN %(products)s
+        """, {"now": timestamp, "user": frappe.session.user, "products": tuple(products)})
+        for product in products:
+            frappe.clear_document_cache("Product", product)
+        clear_product_attachments_cache(products)
 
         frappe.db.commit()
         return {
@@ -121,4 +168,16 @@ def link_attachments_to_products(file_docs, products):
         frappe.log_error('Product Attachment Upload Error', frappe.get_traceback())
         frappe.throw(_('上傳過程出錯：{}').format(str(e)))
         
-        
\ No newline at end of file
+        
+
+
+def reserve_series_names(prefix, count, digits=PRODUCT_ATTACHMENT_LINK_DIGITS):
+    """
+    一次從 naming series 保留 count 個 name（與 frappe getseries 相同的 tabSeries 計數，鎖定後只更新一次）。
+    """
+    if not count:
+        return []
+    frappe.db.sql("INSERT IGNORE INTO `tabSeries` (`name`, `current`) VALUES (%s, 0)", (prefix,))
+    current = frappe.db.sql("SELECT `current` FROM `tabSeries` WHERE `name` = %s FOR UPDATE", (prefix,))[0][0]
+    frappe.db.sql("UPDATE `tabSeries` SET `current` = `current` + %s WHERE `name` = %s", (count, prefix))
+    return [f"{prefix}{str(current + i).zfill(digits)}" for i in range(1, count + 1)]
@@ -1,7 +1,18 @@
 frappe.query_reports["Orders Due to Pay"] = {
-    filters: [],  // 移除頂部 filter box
+    filters: [
+        {
+            fieldname: "rate_basis",
+            label: __("SEK Rate As Of"),
+            fieldtype: "Select",
+            options: "Ship Date\nToday",
+            default: "Ship Date"
+        }
+    ],
     
     onload: function(report) {
+        // 背景匯出（逐列寫檔，完成後通知）
+        hksoho.add_background_export_buttons(report);
+
         // 隱藏所有 dropdown 和 filter 相關功能
         setTimeout(function() {
             // 隱藏 filter row
@@ -20,8 +31,9 @@ frappe.query_reports["Orders Due to Pay"] = {
     formatter: function(value, row, column, data, default_formatter) {
         if (column.fieldname === "details" && data && data.details) {
             const month_name = data.month.split(' ')[0];   // 取出 "March"
+            const rate_basis = frappe.query_report.get_filter_value("rate_basis") || "Ship Date";
             return `<button class="btn btn-xs btn-primary" 
-                            onclick="showDuePODetails('${data.year}', '${month_name}')">
+                            onclick="showDuePODetails('${data.year}', '${month_name}', '${rate_basis}')">
                     View Details
                     </button>`;
         }
@@ -30,20 +42,23 @@ frappe.query_reports["Orders Due to Pay"] = {
 
 };
 
-function showDuePODetails(year, month) {
+function showDuePODetails(year, month, rate_basis) {
     frappe.call({
         method: "hksoho.byrydens.utils.get_due_po_details",
-        args: { year: year, month_name: month },
+        args: { year: year, month_name: month, rate_basis: rate_basis || "Ship Date" },
         callback: function(r) {
             if (r.message && r.message.data && r.message.data.length > 0) {
                 // 計算總額（按幣別分組）
                 let currency_totals = {};
+                let base_currency = r.message.base_currency || 'SEK';
+                let sek_total = 0;
                 
                 r.message.data.forEach(function(row) {
                     if (row.undelivered_value) {
                         let curr = row.currency || 'Unknown';
                         currency_totals[curr] = (currency_totals[curr] || 0) + row.undelivered_value;
                     }
+                    sek_total += row.undelivered_value_sek || 0;
                 });
                 
                 // 建立 HTML 表格
@@ -59,6 +74,8 @@ function showDuePODetails(year, month) {
                                     <th>Status</th>
                                     <th>Currency</th>
                                     <th style="text-align: right;">Undelivered Value</th>
+                                    <th style="text-align: right;">Rate to ${base_currency}</th>
+                                    <th style="text-align: right;">Undelivered Value (${base_currency})</th>
                                 </tr>
                             </thead>
                             <tbody>
@@ -75,6 +92,8 @@ function showDuePODetails(year, month) {
                             <td><span class="badge badge-primary">${row.po_status || ''}</span></td>
                             <td>${row.currency || ''}</td>
                             <td style="text-align: right;">${format_currency(row.undelivered_value, row.currency)}</td>
+                            <td style="text-align: right;">${row.sek_rate ? format_number(row.sek_rate, null, 4) : '<span class="text-danger">No rate</span>'}</td>
+                            <td style="text-align: right;">${row.sek_rate ? format_currency(row.undelivered_value_sek, base_currency) : ''}</td>
                         </tr>
                     `;
                 });
@@ -95,6 +114,8 @@ function showDuePODetails(year, month) {
                 
                 html += `
                                     </td>
+                                    <td></td>
+                                    <td style="text-align: right;">${format_currency(sek_total, base_currency)}</td>
                                 </tr>
                             </tfoot>
                         </table>
@@ -1,23 +1,18 @@
 import frappe
 from frappe import _
 
+from hksoho.byrydens.orders_due_api import (
+    BASE_CURRENCY,
+    RATE_BASIS_SHIP_DATE,
+    get_monthly_due_amounts,
+)
+
 def execute(filters=None):
-    # 使用您系統真正的欄位：confirmed_qty
-    data = frappe.db.sql("""
-        SELECT 
-            YEAR(po.po_shipdate) AS year,
-            MONTH(po.po_shipdate) AS month_num,
-            SUM((item.confirmed_qty - COALESCE(item.booked_qty, 0)) * item.unit_price) AS due_amount
-        FROM `tabPurchase Order` po
-        JOIN `tabPurchase Order Item` item ON item.parent = po.name
-        WHERE po.po_shipdate IS NOT NULL
-          AND item.confirmed_qty > COALESCE(item.booked_qty, 0)
-          AND item.confirmed_qty > 0
-          AND item.unit_price > 0
-        GROUP BY YEAR(po.po_shipdate), MONTH(po.po_shipdate)
-        HAVING due_amount > 0
-        ORDER BY year ASC, month_num ASC
-    """, as_dict=1)
+    filters = filters or {}
+    rate_basis = filters.get("rate_basis") or RATE_BASIS_SHIP_DATE
+
+    # 由 PO Due Summary 彙總表讀取（PO 存檔時更新），並依匯率換算成 SEK
+    data = get_monthly_due_amounts(rate_basis)
 
     if not data:
         return [
@@ -25,31 +20,53 @@ def execute(filters=None):
         ], [{"msg": "目前沒有任何未出貨訂單（confirmed_qty > booked_qty）"}]
 
     rows = []
-    total = 0
+    total_amounts = {}
+    total_sek = 0
+    missing_rates = set()
 
     for d in data:
         month_name = frappe.utils.getdate(f"{d.year}-{d.month_num:02d}-01").strftime("%B %Y")
         rows.append({
             "year": d.year,
             "month": month_name,
-            "due_amount": d.due_amount,
+            "native_amounts": format_native_amounts(d.amounts),
+            "due_amount_sek": d.due_amount_sek,
+            "sek_currency": BASE_CURRENCY,
+            "missing_rates": ", ".join(sorted(d.missing_rates)),
             "details": {"label": "View Details"}
         })
-        total += float(d.due_amount)
+        for currency, amount in d.amounts.items():
+            total_amounts[currency] = total_amounts.get(currency, 0) + amount
+        total_sek += d.due_amount_sek
+        missing_rates |= d.missing_rates
 
     # 總計列
     rows.append({
         "year": "",
         "month": "<strong style='color:#e74c3c; font-size:16px;'>Grand Total (All Time)</strong>",
-        "due_amount": total,
+        "native_amounts": format_native_amounts(total_amounts),
+        "due_amount_sek": total_sek,
+        "sek_currency": BASE_CURRENCY,
+        "missing_rates": ", ".join(sorted(missing_rates)),
         "details": ""
     })
 
     columns = [
-        {"label": "Year",       "fieldname": "year",       "fieldtype": "Int",      "width": 80},
-        {"label": "Month",      "fieldname": "month",      "fieldtype": "Data",     "width": 160},
-        {"label": "Amount Due", "fieldname": "due_amount", "fieldtype": "Currency", "width": 180},
-        {"label": "Details",    "fieldname": "details",    "fieldtype": "Button",   "width": 130}
+        {"label": "Year",             "fieldname": "year",           "fieldtype": "Int",      "width": 80},
+        {"label": "Month",            "fieldname": "month",          "fieldtype": "Data",     "width": 160},
+        {"label": "Amount Due",       "fieldname": "native_amounts", "fieldtype": "Data",     "width": 260},
+        {"label": "Amount Due (SEK)", "fieldname": "due_amount_sek", "fieldtype": "Currency", "options": "sek_currency", "width": 180},
+        {"label": "Missing Rate",     "fieldname": "missing_rates",  "fieldtype": "Data",     "width": 120},
+        {"label": "Details",          "fieldname": "details",        "fieldtype": "Button",   "width": 130}
     ]
 
-    return columns, rows
\ No newline at end of file
+    return columns, rows
+
+
+def format_native_amounts(amounts):
+    """各幣別原幣金額，例如 EUR 1,200.00 / USD 3,000.00"""
+    return " / ".join(
+        f"{currency or 'Unknown'} {frappe.utils.fmt_money(amount, precision=2)}"
+        for currency, amount in sorted(amounts.items())
+        if amount
+    )
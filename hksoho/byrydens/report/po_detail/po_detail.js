@@ -3,6 +3,86 @@
 
 frappe.query_reports["PO detail"] = {
 	"filters": [
+		{
+			"fieldname": "purchase_order",
+			"label": __("Purchase Order"),
+			"fieldtype": "Link",
+			"options": "Purchase Order",
+			"on_change": reset_po_detail_cursor
+		},
+		{
+			"fieldname": "supplier",
+			"label": __("Supplier"),
+			"fieldtype": "Link",
+			"options": "Partner",
+			"on_change": reset_po_detail_cursor
+		},
+		{
+			"fieldname": "article_number",
+			"label": __("Art Nr"),
+			"fieldtype": "Link",
+			"options": "Product",
+			"on_change": reset_po_detail_cursor
+		},
+		{
+			"fieldname": "from_date",
+			"label": __("PO ShipDate From"),
+			"fieldtype": "Date",
+			"on_change": reset_po_detail_cursor
+		},
+		{
+			"fieldname": "to_date",
+			"label": __("PO ShipDate To"),
+			"fieldtype": "Date",
+			"on_change": reset_po_detail_cursor
+		},
+		{
+			"fieldname": "po_status",
+			"label": __("PO Status"),
+			"fieldtype": "Select",
+			"options": "\nPending\nConfirmed\nCancel",
+			"on_change": reset_po_detail_cursor
+		},
+		{
+			"fieldname": "page_length",
+			"label": __("Lines per Page"),
+			"fieldtype": "Select",
+			"options": "100\n500\n1000\n5000",
+			"default": "500",
+			"on_change": reset_po_detail_cursor
+		},
+		{
+			// keyset cursor：上一頁最後一筆的 row_id，由 Next Page 按鈕設定
+			"fieldname": "after",
+			"label": __("After"),
+			"fieldtype": "Int",
+			"hidden": 1
+		}
+	],
 
-	]
+	onload: function(report) {
+		report.page.add_inner_button(__("First Page"), function() {
+			report.set_filter_value("after", 0);
+		});
+
+		report.page.add_inner_button(__("Next Page"), function() {
+			let data = report.data || [];
+			let page_length = cint(report.get_filter_value("page_length")) || 500;
+			if (data.length < page_length) {
+				frappe.show_alert({ message: __("This is the last page"), indicator: "blue" });
+				return;
+			}
+			report.set_filter_value("after", data[data.length - 1].row_id);
+		});
+	}
 };
+
+// 篩選條件改變時回到第一頁
+function reset_po_detail_cursor() {
+	let report = frappe.query_report;
+	if (cint(report.get_filter_value("after"))) {
+		report.set_filter_value("after", 0);
+	} else {
+		report.refresh();
+	}
+}
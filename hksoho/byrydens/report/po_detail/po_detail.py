@@ -1,9 +1,114 @@
 # Copyright (c) 2025, HKSoHo and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
+from frappe import _
+from frappe.utils import cint
+
+DEFAULT_PAGE_LENGTH = 500
+MAX_PAGE_LENGTH = 5000
 
 
 def execute(filters=None):
-	columns, data = [], []
-	return columns, data
+	filters = frappe._dict(filters or {})
+	page_length = min(cint(filters.page_length) or DEFAULT_PAGE_LENGTH, MAX_PAGE_LENGTH)
+
+	# 多取一筆，用來判斷是否還有下一頁（不做 COUNT，大表也只讀一頁）
+	data = get_data(filters, page_length + 1)
+	has_more = len(data) > page_length
+	data = data[:page_length]
+
+	# 下一頁的 cursor 由前端取最後一筆的 row_id
+	message = _("{0} lines on this page").format(len(data))
+	if has_more:
+		message += " – " + _("more lines available, use Next Page")
+
+	return get_columns(), data, message, None, None, True
+
+
+def get_data(filters, limit):
+	"""
+	Keyset 分頁：以 Purchase Order Item 的主鍵（autoincrement）由新到舊排序，
+	下一頁條件為 poi.name < 上一頁最後一筆，避免 OFFSET 掃描。
+	篩選條件只使用有索引的欄位（PO 主鍵、supplier、po_shipdate、article_number）。
+	"""
+	conditions = ["poi.parenttype = 'Purchase Order'", "po.docstatus < 2"]
+	values = {"limit": limit}
+
+	if cint(filters.after):
+		conditions.append("poi.name < %(after)s")
+		values["after"] = cint(filters.after)
+	if filters.purchase_order:
+		conditions.append("poi.parent = %(purchase_order)s")
+		values["purchase_order"] = filters.purchase_order
+	if filters.supplier:
+		conditions.append("po.supplier = %(supplier)s")
+		values["supplier"] = filters.supplier
+	if filters.article_number:
+		conditions.append("poi.article_number = %(article_number)s")
+		values["article_number"] = filters.article_number
+	if filters.from_date:
+		conditions.append("po.po_shipdate >= %(from_date)s")
+		values["from_date"] = filters.from_date
+	if filters.to_date:
+		conditions.append("po.po_shipdate <= %(to_date)s")
+		values["to_date"] = filters.to_date
+	if filters.po_status:
+		conditions.append("po.po_status = %(po_status)s")
+		values["po_status"] = filters.po_status
+
+	return frappe.db.sql(f"""
+		SELECT
+			poi.name AS row_id,
+			po.name AS purchase_order,
+			po.supplier,
+			IFNULL(sp.partner_name, po.supplier) AS supplier_name,
+			po.po_status,
+			po.po_shipdate,
+			po.qc_status,
+			poi.line,
+			poi.article_number,
+			poi.article_name,
+			poi.requested_shipdate_week,
+			poi.confirmed_ship_week,
+			poi.requested_qty,
+			poi.confirmed_qty,
+			poi.qc_accepted_qty,
+			poi.qc_rejected_qty,
+			poi.booked_qty,
+			poi.delivery_qty,
+			poi.remaining_qty,
+			poi.unit_price,
+			po.order_purchase_currency AS currency
+		FROM `tabPurchase Order Item` poi
+		INNER JOIN `tabPurchase Order` po ON po.name = poi.parent
+		LEFT JOIN `tabPartner` sp ON sp.name = po.supplier
+		WHERE {" AND ".join(conditions)}
+		ORDER BY poi.name DESC
+		LIMIT %(limit)s
+	""", values, as_dict=1)
+
+
+def get_columns():
+	return [
+		{"label": _("PO"), "fieldname": "purchase_order", "fieldtype": "Link", "options": "Purchase Order", "width": 130},
+		{"label": _("Supplier"), "fieldname": "supplier", "fieldtype": "Link", "options": "Partner", "width": 100},
+		{"label": _("Supplier Name"), "fieldname": "supplier_name", "fieldtype": "Data", "width": 180},
+		{"label": _("PO Status"), "fieldname": "po_status", "fieldtype": "Data", "width": 90},
+		{"label": _("PO ShipDate"), "fieldname": "po_shipdate", "fieldtype": "Date", "width": 100},
+		{"label": _("Line"), "fieldname": "line", "fieldtype": "Int", "width": 60},
+		{"label": _("Art Nr"), "fieldname": "article_number", "fieldtype": "Link", "options": "Product", "width": 110},
+		{"label": _("Art Name"), "fieldname": "article_name", "fieldtype": "Data", "width": 180},
+		{"label": _("Req Ship Week"), "fieldname": "requested_shipdate_week", "fieldtype": "Data", "width": 100},
+		{"label": _("Cfd Ship Week"), "fieldname": "confirmed_ship_week", "fieldtype": "Data", "width": 100},
+		{"label": _("Order Qty"), "fieldname": "requested_qty", "fieldtype": "Int", "width": 90},
+		{"label": _("Cfd Qty"), "fieldname": "confirmed_qty", "fieldtype": "Int", "width": 90},
+		{"label": _("QC Status"), "fieldname": "qc_status", "fieldtype": "Data", "width": 100},
+		{"label": _("QC Accepted Qty"), "fieldname": "qc_accepted_qty", "fieldtype": "Int", "width": 110},
+		{"label": _("QC Rejected Qty"), "fieldname": "qc_rejected_qty", "fieldtype": "Int", "width": 110},
+		{"label": _("Booked Qty"), "fieldname": "booked_qty", "fieldtype": "Int", "width": 90},
+		{"label": _("Dvy Qty"), "fieldname": "delivery_qty", "fieldtype": "Int", "width": 90},
+		{"label": _("Remain Qty"), "fieldname": "remaining_qty", "fieldtype": "Int", "width": 90},
+		{"label": _("Unit Price"), "fieldname": "unit_price", "fieldtype": "Float", "width": 90},
+		{"label": _("Currency"), "fieldname": "currency", "fieldtype": "Data", "width": 70},
+	]
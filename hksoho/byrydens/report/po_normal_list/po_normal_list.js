@@ -0,0 +1,9 @@
+// Copyright (c) 2026, HKSoHo and contributors
+// For license information, please see license.txt
+
+frappe.query_reports["PO-Normal-List"] = {
+	onload: function(report) {
+		// 大量資料改用背景匯出（逐列寫檔，完成後通知）
+		hksoho.add_background_export_buttons(report);
+	}
+};
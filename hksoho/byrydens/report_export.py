@@ -0,0 +1,214 @@
+"""
+hksoho 報表背景匯出（CSV / XLSX）
+
+預設的報表匯出會把整個結果放進記憶體再寫檔，大量資料時 worker 會被拖垮。
+這裡改為在背景工作中以 unbuffered（server-side）cursor 逐列讀取，
+直接寫入 CSV 或 write-only 的 XLSX，記憶體用量與筆數無關。
+完成後建立 private File 並以 Notification Log 通知使用者。
+"""
+
+import csv
+import hashlib
+import os
+
+import frappe
+from frappe import _
+from frappe.utils import cstr, flt, get_files_path, getdate, now_datetime, scrub, today
+
+from hksoho.byrydens.orders_due_api import RATE_BASIS_SHIP_DATE, RATE_BASIS_TODAY, get_rate_table, get_sek_rate
+
+EXPORT_FORMATS = ("CSV", "Excel")
+EXPORT_JOB_TIMEOUT = 3600
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Orders Due to Pay 匯出每張 PO 的未出貨金額（同 drill-down），依報表的 rate_basis 換算 SEK
+ORDERS_DUE_EXPORT_QUERY = """
+    SELECT
+        s.purchase_order,
+        s.supplier,
+        COALESCE(p.partner_name, s.supplier) AS partner_name,
+        s.po_shipdate,
+        s.po_status,
+        s.year,
+        s.month,
+        s.currency,
+        s.due_amount
+    FROM `tabPO Due Summary` s
+    LEFT JOIN `tabPartner` p ON p.partner_id = s.supplier
+    ORDER BY s.po_shipdate ASC, s.purchase_order ASC
+"""
+ORDERS_DUE_EXPORT_HEADER = [
+    "PO Number", "Partner ID", "Partner Name", "Ship Date", "Status",
+    "Year", "Month", "Currency", "Undelivered Value", "Rate to SEK", "Undelivered Value (SEK)",
+]
+
+
+@frappe.whitelist()
+def export_report(report_name, file_format="CSV", filters=None):
+    """排入背景匯出（filters 為畫面上目前的報表篩選條件），完成後通知目前使用者"""
+    if report_name not in EXPORT_SOURCES:
+        frappe.throw(_("Background export is not available for report {0}").format(report_name))
+    if file_format not in EXPORT_FORMATS:
+        frappe.throw(_("Unsupported export format {0}").format(file_format))
+    if not frappe.get_doc("Report", report_name).is_permitted():
+        frappe.throw(_("Not permitted to export {0}").format(report_name), frappe.PermissionError)
+
+    filters = frappe.parse_json(filters) if isinstance(filters, str) else (filters or {})
+    user = frappe.session.user
+    frappe.enqueue(
+        "hksoho.byrydens.report_export.export_report_job",
+        queue="long",
+        timeout=EXPORT_JOB_TIMEOUT,
+        job_id=f"hksoho_report_export::{report_name}::{file_format}::{user}::{get_filters_hash(filters)}",
+        deduplicate=True,
+        report_name=report_name,
+        file_format=file_format,
+        filters=filters,
+        user=user,
+    )
+    return {"status": "queued"}
+
+
+def export_report_job(report_name, file_format, user, filters=None):
+    extension = "xlsx" if file_format == "Excel" else "csv"
+    file_name = f"{scrub(report_name)}_{now_datetime().strftime('%Y%m%d_%H%M%S')}.{extension}"
+    path = os.path.join(get_files_path(is_private=1), file_name)
+
+    try:
+        # 其他查詢（匯率等）須在開啟 unbuffered cursor 之前完成，
+        # cursor 開啟期間不可再對同一連線下其他查詢
+        open_rows = EXPORT_SOURCES[report_name](frappe._dict(filters or {}))
+        with frappe.db.unbuffered_cursor():
+            header, rows = open_rows()
+            if extension == "xlsx":
+                row_count = write_xlsx(path, report_name, header, rows)
+            else:
+                row_count = write_csv(path, header, rows)
+
+        file_doc = frappe.get_doc({
+            "doctype": "File",
+            "file_name": file_name,
+            "file_url": f"/private/files/{file_name}",
+            "is_private": 1,
+            "file_size": os.path.getsize(path),
+            # 先算好 content hash，避免 File 再把整個檔案讀進記憶體
+            "content_hash": get_file_hash(path),
+            "owner": user,
+        })
+        file_doc.insert(ignore_permissions=True)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        frappe.log_error(title=f"Report export failed: {report_name}")
+        notify_user(user, _("Export of {0} failed").format(report_name))
+        frappe.db.commit()
+        return
+
+    notify_user(
+        user,
+        _("Export of {0} is ready ({1} rows)").format(report_name, row_count),
+        file_doc.name,
+        f'<a href="{file_doc.file_url}">{file_name}</a>',
+    )
+    frappe.db.commit()
+
+
+def write_csv(path, header, rows):
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_xlsx(path, sheet_name, header, rows):
+    from openpyxl import Workbook
+
+    # write-only workbook 逐列寫到暫存檔，不在記憶體保留整張工作表
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=sheet_name[:31])
+    sheet.append(header)
+    count = 0
+    for row in rows:
+        sheet.append(list(row))
+        count += 1
+    workbook.save(path)
+    return count
+
+
+def get_filters_hash(filters):
+    # 篩選條件不同的匯出不可被視為重複工作
+    return hashlib.md5(frappe.as_json(filters, indent=None).encode()).hexdigest()[:10]
+
+
+def get_file_hash(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def notify_user(user, subject, file_name=None, content=None):
+    frappe.get_doc({
+        "doctype": "Notification Log",
+        "for_user": user,
+        "type": "Alert",
+        "subject": subject,
+        "email_content": content or subject,
+        "document_type": "File" if file_name else None,
+        "document_name": file_name,
+    }).insert(ignore_permissions=True)
+
+
+# 匯出來源：在一般 cursor 下準備資料，回傳 open_rows()；
+# open_rows() 於 unbuffered cursor 內執行查詢，回傳 (header, rows iterator)
+
+def query_report_source(report_name):
+    """Query Report：使用報表本身的 SQL，欄名取 "Label:Type:Width" 的 Label"""
+    def prepare(filters):
+        # Query Report 沒有篩選條件，filters 不使用
+        query = frappe.db.get_value("Report", report_name, "query").strip().rstrip(";")
+
+        def open_rows():
+            rows = iter_query(query)
+            header = [cstr(d[0]).split(":")[0] for d in frappe.db._cursor.description]
+            return header, rows
+
+        return open_rows
+    return prepare
+
+
+def orders_due_source(filters):
+    currencies = frappe.db.sql_list("SELECT DISTINCT currency FROM `tabPO Due Summary`")
+    rate_table = get_rate_table(currencies)
+    as_of = getdate(today())
+    use_ship_date = (filters.rate_basis or RATE_BASIS_SHIP_DATE) != RATE_BASIS_TODAY
+
+    def convert(rows):
+        for row in rows:
+            *values, currency, due_amount = row
+            po_shipdate = values[3]
+            rate_date = getdate(po_shipdate) if use_ship_date and po_shipdate else as_of
+            rate = get_sek_rate(rate_table, currency, rate_date)
+            yield [*values, currency, due_amount, rate, flt(flt(due_amount) * rate, 2) if rate else None]
+
+    def open_rows():
+        return ORDERS_DUE_EXPORT_HEADER, convert(iter_query(ORDERS_DUE_EXPORT_QUERY))
+
+    return open_rows
+
+
+def iter_query(query):
+    """逐列回傳查詢結果（tuple），須在 frappe.db.unbuffered_cursor() 內迭代"""
+    return frappe.db.sql(query, as_iterator=True)
+
+
+EXPORT_SOURCES = {
+    "Undelivered Items": query_report_source("Undelivered Items"),
+    "PO-Normal-List": query_report_source("PO-Normal-List"),
+    "Orders Due to Pay": orders_due_source,
+}
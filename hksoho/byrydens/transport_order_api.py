@@ -1,6 +1,12 @@
 import frappe
 from frappe import _
 import json
+import pickle
+
+# Purchase Order workflow states whose lines can be added to a Transport Order
+SHIPPABLE_PO_STATES = ("Ready to Ship", "Partial Shipout")
+PO_ITEM_SHIP_FIELDS = ["name", "line", "article_number", "article_name", "booked_qty", "delivery_qty", "ctns_on_pallet", "carton_cbm", "carton_gross_kg", "unit_price"]
+
 
 @frappe.whitelist()
 def get_po_items(po_name, filters=None):
@@ -9,9 +15,11 @@ def get_po_items(po_name, filters=None):
         frappe.throw("Please provide a valid Purchase Order number")
 
     try:
-        # Check if the Purchase Order has workflow_state = 'Ready to Ship'
-        po = frappe.get_doc("Purchase Order", po_name)
-        if po.workflow_state != "Ready to Ship" and po.workflow_state != 'Partial Shipout':
+        # Check the workflow_state without loading the whole Purchase Order
+        workflow_state = frappe.db.get_value("Purchase Order", po_name, "workflow_state")
+        if workflow_state is None and not frappe.db.exists("Purchase Order", po_name):
+            raise frappe.DoesNotExistError
+        if workflow_state not in SHIPPABLE_PO_STATES:
             frappe.msgprint({
                 "title": "No Data",
                 "message": f"The Purchase Order {po_name} does not have workflow_state 'Ready to Ship'.",
@@ -19,23 +27,22 @@ def get_po_items(po_name, filters=None):
             })
             return []
 
-        # Initialize filters for Purchase Order Item
-        filters = filters or {}
-        filters['parent'] = po_name
-
-        # Fetch items with necessary fields
-        items = frappe.get_all(
-            "Purchase Order Item",
-            filters=filters,
-            fields=["name", "line", "article_number", "article_name", "booked_qty", "delivery_qty", "ctns_on_pallet", "carton_cbm", "carton_gross_kg", "unit_price"],
-            order_by="line asc"
-        )
-
-        # Filter items where qty = booked_qty - delivery_qty > 0
-        filtered_items = [
-            item for item in items
-            if (item.get('booked_qty', 0) - item.get('delivery_qty', 0)) > 0
-        ]
+        if filters:
+            # Extra filters from the caller: keep the generic get_all path
+            filters = frappe.parse_json(filters) if isinstance(filters, str) else filters
+            filters['parent'] = po_name
+            items = frappe.get_all(
+                "Purchase Order Item",
+                filters=filters,
+                fields=PO_ITEM_SHIP_FIELDS,
+                order_by="line asc"
+            )
+            filtered_items = [
+                item for item in items
+                if ((item.get('booked_qty') or 0) - (item.get('delivery_qty') or 0)) > 0
+            ]
+        else:
+            filtered_items = get_shippable_po_items([po_name]).get(po_name, [])
 
         if not filtered_items:
             frappe.msgprint({
@@ -52,14 +59,129 @@ def get_po_items(po_name, filters=None):
     except Exception as e:
         frappe.log_error(f"Error fetching PO items for {po_name}: {str(e)}")
         frappe.throw(f"Failed to fetch Purchase Order items. Please try again later. Error: {str(e)}")
-        
-        
+
+
+@frappe.whitelist()
+def get_po_items_batch(po_names):
+    """
+    Return the shippable remaining lines (booked_qty - delivery_qty > 0) for many Purchase Orders
+    in one query, grouped by PO name. POs that are not 'Ready to Ship' / 'Partial Shipout'
+    are returned with an empty list.
+
+    Args:
+        po_names (str or list): List (or JSON list) of Purchase Order names
+    Returns:
+        dict: {po_name: [item, ...]}
+    """
+    po_names = parse_po_names(po_names)
+    if not po_names:
+        frappe.throw("Please provide at least one Purchase Order number")
+
+    if not frappe.has_permission("Purchase Order", "read"):
+        frappe.throw("You do not have sufficient permissions to access Purchase Order items. Please contact your administrator for access.", frappe.PermissionError)
+
+    return get_shippable_po_items(po_names)
+
+
+def parse_po_names(po_names):
+    """Normalize a JSON list, a list or a single PO name into a de-duplicated list of PO names."""
+    if isinstance(po_names, str):
+        po_names = frappe.parse_json(po_names) if po_names.lstrip().startswith("[") else [po_names]
+    return list(dict.fromkeys(p for p in (po_names or []) if p))
+
+
+def get_shippable_po_items(po_names):
+    """Fetch shippable lines of the given POs with the workflow state check and qty filter done in SQL."""
+    items = frappe.db.sql("""
+        SELECT
+            item.parent AS po_number,
+            {fields}
+        FROM `tabPurchase Order Item` item
+        JOIN `tabPurchase Order` po ON po.name = item.parent
+        WHERE item.parent IN %(po_names)s
+          AND item.parenttype = 'Purchase Order'
+          AND po.workflow_state IN %(states)s
+          AND IFNULL(item.booked_qty, 0) - IFNULL(item.delivery_qty, 0) > 0
+        ORDER BY item.parent, item.line
+    """.format(fields=", ".join(f"item.{f}" for f in PO_ITEM_SHIP_FIELDS)),
+        {"po_names": tuple(po_names), "states": SHIPPABLE_PO_STATES},
+        as_dict=True
+    )
+
+    grouped = {po_name: [] for po_name in po_names}
+    for item in items:
+        grouped[item.po_number].append(item)
+    return grouped
+
+
+# Product 外箱資料快取 (Redis hash: article_number -> {ctns, cbm, gross_kg})
+PRODUCT_DIMENSIONS_CACHE_KEY = "hksoho:product_dimensions"
+PRODUCT_DIMENSION_FIELDS = {
+    "ctns": "number_of_cartons_colli_per_unit",
+    "cbm": "carton_cbm_outer_carton",
+    "gross_kg": "carton_weight_kg_outer_carton",
+}
+
+
+@frappe.whitelist()
+def get_product_dimensions(article_numbers):
+    """
+    Return the outer carton data for many Products in one call.
+
+    Args:
+        article_numbers (list or str): Article numbers (Product names), list or JSON list
+    Returns:
+        dict: {article_number: {"ctns": ..., "cbm": ..., "gross_kg": ...}};
+              unknown article numbers are left out
+    """
+    if isinstance(article_numbers, str):
+        article_numbers = frappe.parse_json(article_numbers)
+    article_numbers = list(dict.fromkeys(a for a in (article_numbers or []) if a))
+    if not article_numbers:
+        return {}
+    frappe.has_permission("Product", "read", throw=True)
+
+    # 一次 HMGET 取回所有快取（值與 hset 相同，以 pickle 儲存）
+    cache = frappe.cache()
+    cached_values = cache.hmget(cache.make_key(PRODUCT_DIMENSIONS_CACHE_KEY), article_numbers)
+    result = {}
+    missing = []
+    for article_number, cached in zip(article_numbers, cached_values):
+        if cached is None:
+            missing.append(article_number)
+        else:
+            result[article_number] = pickle.loads(cached)
+
+    if missing:
+        products = frappe.get_list(
+            "Product",
+            filters={"name": ["in", missing]},
+            fields=["name"] + list(PRODUCT_DIMENSION_FIELDS.values())
+        )
+        for product in products:
+            dimensions = {key: product.get(field) for key, field in PRODUCT_DIMENSION_FIELDS.items()}
+            cache.hset(PRODUCT_DIMENSIONS_CACHE_KEY, product.name, dimensions)
+            result[product.name] = dimensions
+
+    return result
+
+
+def clear_product_dimensions_cache(article_number=None):
+    """Drop one Product (or all) from the outer carton data cache"""
+    if article_number:
+        frappe.cache().hdel(PRODUCT_DIMENSIONS_CACHE_KEY, article_number)
+    else:
+        frappe.cache().delete_key(PRODUCT_DIMENSIONS_CACHE_KEY)
+
+
+# Transport Order Line invoice fields cleared when invoice_received is unchecked
+INVOICE_FIELDS = ("invoice_no", "invoice_currency", "invoice_date", "invoice_due_date", "invoice_paid", "exchange_rate_to_sek")
 
 
 @frappe.whitelist()
 def update_to_line_invoice(to_name, po_number, invoice_data):
     """
-    Update invoice details for Transport Order Line items matching the given po_number and save the Transport Order.
+    Update invoice details for Transport Order Line items matching the given po_number.
 
     Args:
         to_name (str): Name of the Transport Order
@@ -77,62 +199,88 @@ def update_to_line_invoice(to_name, po_number, invoice_data):
     Returns:
         dict: Result message indicating success or failure
     """
-    try:
-        # Parse invoice_data if it's a string
-        if isinstance(invoice_data, str):
+    if isinstance(invoice_data, str):
+        try:
             invoice_data = json.loads(invoice_data)
-        elif not isinstance(invoice_data, dict):
-            frappe.throw(_("Invalid invoice_data format. Expected a dictionary or JSON string."))
+        except ValueError:
+            invoice_data = None
+    return update_to_line_invoices(to_name, {po_number: invoice_data})
 
-        # Get Transport Order
-        to_doc = frappe.get_doc("Transport Order", to_name)
 
-        # Validate po_line links
-        invalid_lines = []
-        for item in to_doc.items:
-            if item.po_number == po_number and item.po_line:
-                if not frappe.db.exists("Purchase Order Item", item.po_line):
-                    invalid_lines.append(f"Row #{item.idx}: PO Line: {item.po_line}")
+@frappe.whitelist()
+def update_to_line_invoices(to_name, invoices):
+    """
+    Update invoice details for the Transport Order Lines of several Purchase Orders in one call
+    (e.g. a forwarder's consolidated invoice). All referenced PO lines are validated with one
+    IN query and only the matching Transport Order Line rows are written.
 
+    Args:
+        to_name (str): Name of the Transport Order
+        invoices (str, dict or list): {po_number: invoice_data, ...} or
+            [{"po_number": ..., "invoice_received": 1, ...}, ...], as dict or JSON string
+    Returns:
+        dict: Result message indicating success or failure
+    """
+    try:
+        invoices = _parse_invoices(invoices)
+        frappe.has_permission("Transport Order", "write", to_name, throw=True)
+
+        lines = frappe.get_all(
+            "Transport Order Line",
+            filters={"parent": to_name, "parenttype": "Transport Order", "po_number": ["in", list(invoices)]},
+            fields=["name", "idx", "po_number", "po_line"],
+            order_by="idx asc"
+        )
+
+        missing_pos = [po for po in invoices if po not in {line.po_number for line in lines}]
+        if missing_pos:
+            frappe.throw(_("No items found matching the selected Purchase Order: {0}").format(", ".join(missing_pos)))
+
+        # Validate all po_line links in one query
+        po_lines = {str(line.po_line) for line in lines if line.po_line}
+        existing = {
+            str(name) for name in frappe.get_all(
+                "Purchase Order Item", filters={"name": ["in", list(po_lines)]}, pluck="name"
+            )
+        } if po_lines else set()
+        invalid_lines = [
+            f"Row #{line.idx}: PO Line: {line.po_line}"
+            for line in lines if line.po_line and str(line.po_line) not in existing
+        ]
         if invalid_lines:
             frappe.throw(_("Could not find the following PO Line references: {0}").format(", ".join(invalid_lines)))
 
-        # Validate invoice data
-        if invoice_data.get("invoice_received") and invoice_data.get("invoice_date") and invoice_data.get("invoice_due_date"):
-            if invoice_data["invoice_due_date"] < invoice_data["invoice_date"]:
-                frappe.throw(_("Invoice Due Date cannot be earlier than Invoice Date."))
+        values_by_po = {po_number: _get_invoice_values(invoice_data) for po_number, invoice_data in invoices.items()}
+
+        # frappe.db.set_value skips Link validation, so check all submitted currencies in one query
+        currencies = {values["invoice_currency"] for values in values_by_po.values() if values.get("invoice_currency")}
+        if currencies:
+            invalid_currencies = currencies - set(
+                frappe.get_all("Currency", filters={"name": ["in", list(currencies)]}, pluck="name")
+            )
+            if invalid_currencies:
+                frappe.throw(_("Invalid Invoice Currency: {0}").format(", ".join(sorted(invalid_currencies))))
+
+        # Apply line updates per PO, without loading or re-validating the whole Transport Order
+        updated_lines = 0
+        for po_number, values in values_by_po.items():
+            frappe.db.set_value(
+                "Transport Order Line",
+                {"parent": to_name, "parenttype": "Transport Order", "po_number": po_number},
+                values,
+                update_modified=False
+            )
+            updated_lines += sum(1 for line in lines if line.po_number == po_number)
 
-        updated = False
-        # Update Transport Order Line
-        for item in to_doc.items:
-            if item.po_number == po_number:
-                item.invoice_received = invoice_data.get("invoice_received", 0)
-                if item.invoice_received:
-                    item.invoice_no = invoice_data.get("invoice_no")
-                    item.invoice_currency = invoice_data.get("invoice_currency")
-                    item.invoice_date = invoice_data.get("invoice_date")
-                    item.invoice_due_date = invoice_data.get("invoice_due_date")
-                    item.invoice_paid = invoice_data.get("invoice_paid", 0)
-                    item.exchange_rate_to_sek = invoice_data.get("exchange_rate_to_sek")
-                else:
-                    item.invoice_no = None
-                    item.invoice_currency = None
-                    item.invoice_date = None
-                    item.invoice_due_date = None
-                    item.invoice_paid = 0
-                    item.exchange_rate_to_sek = None
-                updated = True
-
-        if not updated:
-            frappe.throw(_("No items found matching the selected Purchase Order: {0}").format(po_number))
-
-        # Save Transport Order
-        to_doc.save(ignore_permissions=True)
+        frappe.db.set_value("Transport Order", to_name, "modified", frappe.utils.now(), update_modified=False)
+        frappe.clear_document_cache("Transport Order", to_name)
         frappe.db.commit()
 
         return {
             "status": "success",
-            "message": "Invoice details updated and form saved successfully!"
+            "message": f"Invoice details updated on {updated_lines} line(s) for {len(invoices)} Purchase Order(s).",
+            "updated_lines": updated_lines,
+            "po_count": len(invoices)
         }
 
     except Exception as e:
@@ -143,6 +291,38 @@ def update_to_line_invoice(to_name, po_number, invoice_data):
             "status": "error",
             "message": f"Failed to update invoice details: {error_message}"
         }
+
+
+def _parse_invoices(invoices):
+    """Normalize the invoices argument to {po_number: invoice_data}."""
+    if isinstance(invoices, str):
+        invoices = json.loads(invoices)
+    if isinstance(invoices, list):
+        invoices = {row.get("po_number"): row for row in invoices if isinstance(row, dict)}
+    if not isinstance(invoices, dict) or not invoices:
+        frappe.throw(_("Invalid invoice_data format. Expected a dictionary or JSON string."))
+
+    for po_number, invoice_data in invoices.items():
+        if not po_number or not isinstance(invoice_data, dict):
+            frappe.throw(_("Invalid invoice_data format. Expected a dictionary or JSON string."))
+        # Validate invoice data
+        if invoice_data.get("invoice_received") and invoice_data.get("invoice_date") and invoice_data.get("invoice_due_date"):
+            if invoice_data["invoice_due_date"] < invoice_data["invoice_date"]:
+                frappe.throw(_("Invoice Due Date cannot be earlier than Invoice Date."))
+    return invoices
+
+
+def _get_invoice_values(invoice_data):
+    """Build the Transport Order Line field values for one PO's invoice data."""
+    invoice_received = frappe.utils.cint(invoice_data.get("invoice_received", 0))
+    if not invoice_received:
+        values = {fieldname: None for fieldname in INVOICE_FIELDS}
+        values["invoice_paid"] = 0
+    else:
+        values = {fieldname: invoice_data.get(fieldname) for fieldname in INVOICE_FIELDS}
+        values["invoice_paid"] = frappe.utils.cint(invoice_data.get("invoice_paid", 0))
+    values["invoice_received"] = invoice_received
+    return values
         
 import frappe
 from datetime import timedelta
@@ -160,6 +340,13 @@ if not logger.handlers:
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
+# 批次 UPDATE 時每次 IN (...) 的筆數上限
+UPDATE_BATCH_SIZE = 500
+# 船期同步時每批處理的 Transport Order 數量（每批回報一次進度）
+CASCADE_TO_BATCH_SIZE = 10
+# 每個背景重新匯出工作處理的 PO 數量
+PO_EXPORT_JOB_SIZE = 50
+
 @frappe.whitelist()
 def update_vessel_dates1(vessel_name, cfs_close=None, etd_date=None, eta_date=None, dest_port_free_days=0, to_name=None):
     # 寫入自訂 log file
@@ -248,82 +435,22 @@ def update_vessel_dates(vessel_name, cfs_close=None, etd_date=None, eta_date=Non
     vessel_doc.etd_date = etd_date
     vessel_doc.eta_date = eta_date
     vessel_doc.dest_port_free_days = dest_port_free_days
+    # 本函式自行處理 to_name，其餘 Transport Order 於下方排入船期同步（排除 to_name），
+    # 不讓 on_update 再排一次完整同步
+    vessel_doc.flags.skip_schedule_cascade = True
     vessel_doc.save(ignore_permissions=True)
+    schedule_changed = vessel_doc.schedule_changed()
     logger.debug("Vessels Time Table 已更新")
 
-    # 2. 更新相關 PO Item 的 confirmed_shipdate
+    # 2. 更新相關 PO Item 的 confirmed_shipdate（一次查詢 + 批次寫入）
     updated_items = 0
+    changed_pos = []
     if to_name and eta_date:
-        logger.debug(f"開始更新 Transport Order [{to_name}] 相關 PO 的 confirmed_shipdate")
-
-        to_doc = frappe.get_doc('Transport Order', to_name)
-        logger.debug(f"🔍 TO [{to_name}] 共有 {len(to_doc.items)} 個 items")
-
-        eta_date_obj = frappe.utils.getdate(eta_date)
-        new_confirmed_shipdate = eta_date_obj - timedelta(days=60)
-        logger.debug(f"新的 Confirmed Ship Date: {new_confirmed_shipdate}")
-
-        po_docs_to_save = {}
+        new_confirmed_shipdate = frappe.utils.getdate(eta_date) - timedelta(days=60)
+        logger.debug(f"TO [{to_name}] 新的 Confirmed Ship Date: {new_confirmed_shipdate}")
 
-        for line in to_doc.items:
-            logger.debug(f"🔍 TO Line: {line.name}, po_line: {getattr(line, 'po_line', 'None')}")
-            if not line.po_line:
-                continue
-
-            # 取出 PO name（parent）
-            po_name = frappe.db.get_value('Purchase Order Item', line.po_line, 'parent')
-            if not po_name:
-                logger.warning(f"TO Line {line.name} 的 po_line {line.po_line} 無對應 PO")
-                continue
-
-            logger.debug(f"處理 TO Line [{line.name}] po_line={line.po_line} → PO={po_name}")
-
-            if po_name not in po_docs_to_save:
-                po_docs_to_save[po_name] = frappe.get_doc('Purchase Order', po_name)
-
-            po_doc = po_docs_to_save[po_name]
-
-            # ✅ 注意：這裡要用 po_items，不是 items
-            logger.debug(f"PO [{po_name}] 共有 {len(po_doc.po_items)} 個 po_items")
-            found_match = False
-
-            for idx, item in enumerate(po_doc.po_items):
-                logger.debug(
-                    f"  PO Item {idx}: name={item.name}, article={getattr(item, 'article_number', 'N/A')}"
-                )
-                logger.debug(
-                    f"    比對用 → item.name={item.name} ({type(item.name)}), "
-                    f"po_line={line.po_line} ({type(line.po_line)})"
-                )
-
-                # ✅ 統一用字串比對，避免 '683' vs 683 型別不一致
-                if str(item.name) == str(line.po_line):
-                    old_value = item.confirmed_shipdate
-                    logger.debug(
-                        f"##PO [{po_name}] 的 Item [{item.name}] "
-                        f"confirmed_shipdate 更新: {old_value} → {new_confirmed_shipdate}"
-                    )
-
-                    item.confirmed_shipdate = new_confirmed_shipdate
-                    updated_items += 1
-                    found_match = True
-                    logger.debug(f"✓ 已更新 PO [{po_name}] Item [{item.name}]")
-                    break
-
-            if not found_match:
-                logger.warning(f"❌ PO [{po_name}] 中找不到 po_line = {line.po_line}")
-
-        # 儲存所有有被修改過的 PO
-        update_count = 0
-        for po_name, po_doc in po_docs_to_save.items():
-            try:
-                po_doc.save(ignore_permissions=True)
-                logger.debug(f"Purchase Order [{po_name}] 已儲存")
-                update_count += 1
-            except Exception as e:
-                logger.error(f"儲存 Purchase Order [{po_name}] 失敗: {str(e)}")
-
-        logger.debug(f"總共更新 {updated_items} 個 Item，儲存 {update_count} 筆 PO")
+        updated_items, changed_pos = update_po_confirmed_shipdate([to_name], new_confirmed_shipdate)
+        logger.debug(f"總共更新 {updated_items} 個 Item，影響 {len(changed_pos)} 筆 PO: {changed_pos}")
 
     # 3. 更新 Transport Order 本身欄位（如果需要）
     if to_name:
@@ -341,219 +468,307 @@ def update_vessel_dates(vessel_name, cfs_close=None, etd_date=None, eta_date=Non
             logger.debug(f"Transport Order [{to_name}] 已更新（CFS/ETD/ETA/Free Days）")
 
     frappe.db.commit()
-    logger.debug("=== update_vessel_dates 執行完畢 ===")
-    return {"status": "success", "updated_items": updated_items}
 
+    # 4. 只重新匯出有變動的 PO（背景執行）
+    enqueue_po_export(changed_pos)
 
+    # 5. 同一船期的其他 Transport Order
+    if schedule_changed:
+        enqueue_vessel_schedule_cascade(vessel_name, exclude_to_names=[to_name] if to_name else None)
+    logger.debug("=== update_vessel_dates 執行完畢 ===")
+    return {"status": "success", "updated_items": updated_items, "updated_pos": changed_pos}
 
-# 2. 更新 Transport Order → 改用 set_value 強制寫入（完全無視 workflow 凍結）
-    if to_name:
-        updates = {}
-        if cfs_close:          
-            updates["cfs_close"] = cfs_close
-        if etd_date:           
-            updates["etd_date"] = etd_date
-            #updates["booked_etd"] = etd_date
-        if eta_date:           
-            updates["eta_date"] = eta_date
-            updates["dest_port_free_days"] = int(dest_port_free_days)
 
-        frappe.db.set_value("Transport Order", to_name, updates)
+def update_po_confirmed_shipdate(to_names, new_confirmed_shipdate):
+    """
+    將指定 Transport Order 所有 Line 對應的 PO Item.confirmed_shipdate 更新為 new_confirmed_shipdate。
+    以一次 JOIN 查詢取得 po_line → PO 的對應，只寫入日期確實不同的項目，並分批 UPDATE。
 
-    frappe.db.commit()
-    return {"status": "success"}
-    
+    Returns:
+        tuple: (更新的 PO Item 數量, 有變動的 PO 名稱列表)
+    """
+    if not to_names:
+        return 0, []
+
+    rows = frappe.db.sql("""
+        SELECT DISTINCT poi.name, poi.parent, poi.confirmed_shipdate
+        FROM `tabTransport Order Line` tol
+        JOIN `tabPurchase Order Item` poi ON poi.name = tol.po_line
+        WHERE tol.parent IN %(to_names)s
+          AND tol.parenttype = 'Transport Order'
+          AND IFNULL(tol.po_line, '') != ''
+    """, {"to_names": tuple(to_names)}, as_dict=True)
+
+    to_update = [
+        row for row in rows
+        if not row.confirmed_shipdate or frappe.utils.getdate(row.confirmed_shipdate) != new_confirmed_shipdate
+    ]
+    if not to_update:
+        return 0, []
+
+    iso = new_confirmed_shipdate.isocalendar()
+    ship_week = f"{str(new_confirmed_shipdate.year)[-2:]}-{str(iso[1]).zfill(2)}"
+    now = frappe.utils.now()
+    item_names = [row.name for row in to_update]
+    for start in range(0, len(item_names), UPDATE_BATCH_SIZE):
+        frappe.db.sql("""
+            UPDATE `tabPurchase Order Item`
+            SET confirmed_shipdate = %(shipdate)s,
+                confirmed_ship_week = %(ship_week)s,
+                modified = %(now)s
+            WHERE name IN %(names)s
+        """, {
+            "shipdate": new_confirmed_shipdate,
+            "ship_week": ship_week,
+            "now": now,
+            "names": tuple(item_names[start:start + UPDATE_BATCH_SIZE]),
+        })
+
+    changed_pos = sorted({row.parent for row in to_update})
+    for po_name in changed_pos:
+        frappe.clear_document_cache("Purchase Order", po_name)
+    return len(to_update), changed_pos
 
 
 @frappe.whitelist()
-def fix_po_item_order_status_for_shipped_to(dry_run=False, reset_status_to=""):
+def cascade_vessel_schedule(vessel_name):
     """
-    清理錯誤標記為 Shipped 的 Purchase Order Item.order_status。
-    只保留「在 workflow_state = 'Shipped' 的 Transport Order Line 上」那些 PO Item 為 Shipped。
-    
-    :param dry_run: True = 只列出會被更新的資料，不真的寫入 DB
-    :param reset_status_to: 要改回的值，例如 "" 或 "Pending"
+    手動觸發：將 Vessels Time Table 的船期套用到所有使用此船期的 Transport Order
+    以及其 PO Item 的 confirmed_shipdate（背景執行）。
     """
-    logger = frappe.logger("to_po_fix")
-
-    # 1. 找出所有 workflow_state = 'Shipped' 的 Transport Order
-    shipped_to_names = frappe.get_all(
-        "Transport Order",
-        filters={"workflow_state": "Shipped"},
-        pluck="name"
+    frappe.has_permission("Vessels Time Table", "write", vessel_name, throw=True)
+    enqueue_vessel_schedule_cascade(vessel_name)
+    return {"status": "queued", "vessel_name": vessel_name}
+
+
+def enqueue_vessel_schedule_cascade(vessel_name, exclude_to_names=None):
+    """將船期同步工作排入 long 佇列，於交易 commit 後執行。exclude_to_names 為已由呼叫端更新的 Transport Order。"""
+    frappe.enqueue(
+        "hksoho.byrydens.transport_order_api.cascade_vessel_schedule_job",
+        queue="long",
+        vessel_name=vessel_name,
+        exclude_to_names=exclude_to_names,
+        user=frappe.session.user,
+        enqueue_after_commit=True,
     )
-    logger.info(f"找到 {len(shipped_to_names)} 筆 Shipped 狀態的 TO")
 
-    # 2. 收集這些 TO Line 上的 po_line (= PO Item.name)
-    valid_po_item_names = set()
-    if shipped_to_names:
-        to_lines = frappe.get_all(
-            "Transport Order Line",
-            filters={"parent": ["in", shipped_to_names]},
-            fields=["name", "parent", "po_line"]
-        )
-        for line in to_lines:
-            if line.po_line:
-                valid_po_item_names.add(str(line.po_line))
 
-    logger.info(f"在 Shipped TO Line 中，共有 {len(valid_po_item_names)} 筆 PO Item 應為 Shipped")
+def cascade_vessel_schedule_job(vessel_name, exclude_to_names=None, user=None):
+    """
+    背景工作：找出所有 vessel = vessel_name 的 Transport Order，批次更新 cfs_close/etd_date/eta_date，
+    並依 ETA 分批更新 PO Item.confirmed_shipdate，過程中以 publish_progress 回報進度。
+    """
+    vessel = frappe.db.get_value(
+        "Vessels Time Table", vessel_name,
+        ["cfs_close", "etd_date", "eta_date", "dest_port_free_days"],
+        as_dict=True
+    )
+    if not vessel:
+        return
+
+    filters = {"vessel": vessel_name, "cancelled": 0}
+    if exclude_to_names:
+        filters["name"] = ["not in", exclude_to_names]
+    to_names = frappe.get_all("Transport Order", filters=filters, pluck="name")
+    logger.debug(f"[CASCADE] Vessel [{vessel_name}] 共有 {len(to_names)} 筆 Transport Order")
+    if not to_names:
+        return
+
+    # 1. 批次更新 Transport Order 表頭船期（與 update_vessel_dates 相同規則）
+    updates = {}
+    if vessel.cfs_close:
+        updates["cfs_close"] = vessel.cfs_close
+    if vessel.etd_date:
+        updates["etd_date"] = vessel.etd_date
+    if vessel.eta_date:
+        updates["eta_date"] = vessel.eta_date
+        updates["dest_port_free_days"] = int(vessel.dest_port_free_days or 0)
+    if updates:
+        frappe.db.set_value("Transport Order", {"name": ["in", to_names]}, updates)
+        frappe.db.commit()
 
-    # 3. 找出目前 order_status = 'Shipped' 的所有 PO Item
-    shipped_po_items = frappe.get_all(
-        "Purchase Order Item",
-        filters={"order_status": "Shipped"},
-        fields=["name", "parent", "order_status"]
+    # 2. 分批更新 PO Item.confirmed_shipdate
+    updated_items = 0
+    changed_pos = set()
+    if vessel.eta_date:
+        new_confirmed_shipdate = frappe.utils.getdate(vessel.eta_date) - timedelta(days=60)
+        for start in range(0, len(to_names), CASCADE_TO_BATCH_SIZE):
+            batch = to_names[start:start + CASCADE_TO_BATCH_SIZE]
+            count, pos = update_po_confirmed_shipdate(batch, new_confirmed_shipdate)
+            updated_items += count
+            changed_pos.update(pos)
+            frappe.db.commit()
+
+            done = min(start + CASCADE_TO_BATCH_SIZE, len(to_names))
+            frappe.publish_progress(
+                done * 100 / len(to_names),
+                title=_("Updating Transport Orders"),
+                doctype="Vessels Time Table",
+                docname=vessel_name,
+                description=_("{0} of {1} Transport Orders").format(done, len(to_names)),
+            )
+
+    # 3. 只重新匯出有變動的 PO
+    enqueue_po_export(sorted(changed_pos))
+    logger.debug(
+        f"[CASCADE] Vessel [{vessel_name}] 完成：{len(to_names)} 筆 TO，"
+        f"{updated_items} 個 PO Item，{len(changed_pos)} 筆 PO 待重新匯出"
     )
-    logger.info(f"目前資料庫中，order_status = 'Shipped' 的 PO Item 共 {len(shipped_po_items)} 筆")
-
-    # 4. 過濾出「不在 valid_po_item_names 中」的 → 代表應該被清掉
-    to_reset = []
-    for row in shipped_po_items:
-        if str(row.name) not in valid_po_item_names:
-            to_reset.append(row)
-
-    logger.info(f"其中有 {len(to_reset)} 筆 PO Item 的 Shipped 狀態是多餘的，將被重設為 '{reset_status_to}'")
-
-    # if dry_run:
-    #     # 只印出名單，不動資料
-    #     for r in to_reset[:200]:
-    #         logger.info(f"[DRY RUN] 會被重設的 PO Item: {r.name} (PO: {r.parent})")
-    #     return {
-    #         "dry_run": True,
-    #         "to_reset_count": len(to_reset)
-    #     }
-
-    # 5. 實際更新這些錯誤的 PO Item
-    for r in to_reset:
-        frappe.db.set_value(
-            "Purchase Order Item",
-            r.name,
-            "order_status",
-            reset_status_to
-        )
 
-    frappe.db.commit()
-    logger.info(f"實際已重設 {len(to_reset)} 筆 PO Item.order_status 為 '{reset_status_to}'")
+    if user:
+        frappe.publish_realtime(
+            "msgprint",
+            _("Vessel schedule {0} applied to {1} Transport Order(s), {2} PO line(s) updated.").format(
+                vessel_name, len(to_names), updated_items
+            ),
+            user=user,
+        )
 
-    return {
-        "dry_run": False,
-        "reset_to": reset_status_to,
-        "affected_rows": len(to_reset)
-    }
 
+def enqueue_po_export(po_names):
+    """將需要重新匯出 Pyramid 檔案的 PO 排入背景佇列（透過 save 觸發 before_save），每個工作最多 PO_EXPORT_JOB_SIZE 張。"""
+    po_names = list(po_names or [])
+    for start in range(0, len(po_names), PO_EXPORT_JOB_SIZE):
+        frappe.enqueue(
+            "hksoho.byrydens.transport_order_api.export_purchase_orders",
+            queue="short",
+            po_names=po_names[start:start + PO_EXPORT_JOB_SIZE],
+            enqueue_after_commit=True,
+        )
 
-import frappe
 
-@frappe.whitelist()
-def fix_po_item_order_status_and_trigger_before_save(dry_run=True, reset_status_to=""):
+def export_purchase_orders(po_names):
+    """背景工作：逐張儲存 PO 以觸發 before_save 重新匯出。"""
+    for po_name in po_names:
+        try:
+            frappe.get_doc("Purchase Order", po_name).save(ignore_permissions=True)
+            frappe.db.commit()
+            logger.debug(f"Purchase Order [{po_name}] 已重新匯出")
+        except Exception as e:
+            frappe.db.rollback()
+            logger.error(f"重新匯出 Purchase Order [{po_name}] 失敗: {str(e)}")
+            frappe.log_error(f"Failed to re-export PO {po_name}: {str(e)}", "PO Re-export")
+
+
+# order_status = 'Shipped' 但不在任何 Shipped Transport Order Line 上的 PO Item
+STALE_SHIPPED_QUERY = """
+    SELECT poi.name, poi.parent, poi.order_status
+    FROM `tabPurchase Order Item` poi
+    LEFT JOIN (
+        SELECT DISTINCT tol.po_line
+        FROM `tabTransport Order Line` tol
+        JOIN `tabTransport Order` tor ON tor.name = tol.parent
+        WHERE tor.workflow_state = 'Shipped'
+          AND tol.parenttype = 'Transport Order'
+          AND IFNULL(tol.po_line, '') != ''
+    ) shipped ON shipped.po_line = poi.name
+    WHERE poi.order_status = 'Shipped'
+      AND shipped.po_line IS NULL
+    ORDER BY poi.name
+"""
+# 修正時每批以主鍵 UPDATE 的筆數（每批一次 UPDATE + commit，避免長時間鎖表）
+FIX_CHUNK_SIZE = 5000
+
+
+def _reset_stale_shipped_status(dry_run, reset_status_to, log_prefix=""):
     """
-    1) 找出所有 order_status = 'Shipped' 的 Purchase Order Item
-    2) 只保留「有在 workflow_state = 'Shipped' 的 Transport Order Line 上」那幾筆
-    3) 其他多餘的改回 reset_status_to
-    4) 對受影響的 Purchase Order 呼叫 save()，觸發 before_save
+    以一次 JOIN 查詢找出 order_status = 'Shipped' 但不在任何 Shipped Transport Order Line 上的 PO Item，
+    dry_run 時只回傳差異清單，否則依主鍵每 FIX_CHUNK_SIZE 筆 UPDATE 一次並 commit。
+
+    Returns:
+        dict: {"items": [...], "affected_pos": set, "reset_count": int}
     """
     logger = frappe.logger("to_po_fix")
 
-    # -------------------------------
-    # A. 收集 Shipped TO Line 對應的 PO Item（真正應該是 Shipped 的）
-    # -------------------------------
-    shipped_to_names = frappe.get_all(
-        "Transport Order",
-        filters={"workflow_state": "Shipped"},
-        pluck="name"
-    )
-    logger.info(f"[FIX] 找到 {len(shipped_to_names)} 筆 Shipped 狀態的 TO")
-
-    valid_po_item_names = set()
-    if shipped_to_names:
-        to_lines = frappe.get_all(
-            "Transport Order Line",
-            filters={"parent": ["in", shipped_to_names]},
-            fields=["name", "parent", "po_line"]
-        )
-        for line in to_lines:
-            if line.po_line:
-                valid_po_item_names.add(str(line.po_line))
+    items = frappe.db.sql(STALE_SHIPPED_QUERY, as_dict=True)
+    affected_pos = {row.parent for row in items}
+    reset_count = 0
+
+    if not dry_run:
+        now = frappe.utils.now()
+        for start in range(0, len(items), FIX_CHUNK_SIZE):
+            names = [row.name for row in items[start:start + FIX_CHUNK_SIZE]]
+            # 仍為 Shipped 才重設，避免覆寫查詢後被其他流程更新的狀態
+            frappe.db.sql("""
+                UPDATE `tabPurchase Order Item`
+                SET order_status = %(reset_status_to)s,
+                    modified = %(now)s
+                WHERE name IN %(names)s
+                  AND order_status = 'Shipped'
+            """, {"names": tuple(names), "reset_status_to": reset_status_to, "now": now})
+            # 以實際更新的筆數計算（查詢後已被改掉狀態的不算）
+            reset_count += frappe.db._cursor.rowcount
+            frappe.db.commit()
+            logger.info(f"{log_prefix}已重設 {reset_count} / {len(items)} 筆 PO Item")
 
-    logger.info(f"[FIX] 在 Shipped TO Line 中，共有 {len(valid_po_item_names)} 筆 PO Item 應為 Shipped")
-
-    # -------------------------------
-    # B. 找出目前被標為 Shipped 的 PO Item
-    # -------------------------------
-    shipped_po_items = frappe.get_all(
-        "Purchase Order Item",
-        filters={"order_status": "Shipped"},
-        fields=["name", "parent", "order_status"]
+    logger.info(
+        f"{log_prefix}共有 {len(items)} 筆 PO Item 的 Shipped 狀態是多餘的，"
+        f"影響 {len(affected_pos)} 張 PO，dry_run={dry_run}"
     )
-    logger.info(f"[FIX] 目前資料庫中，order_status = 'Shipped' 的 PO Item 共 {len(shipped_po_items)} 筆")
+    return {"items": items, "affected_pos": affected_pos, "reset_count": reset_count}
 
-    # -------------------------------
-    # C. 篩出「不在 valid_po_item_names 中」的 → 應該被還原
-    # -------------------------------
-    to_reset = []
-    affected_po_names = set()
 
-    for row in shipped_po_items:
-        if str(row.name) not in valid_po_item_names:
-            to_reset.append(row)
-            affected_po_names.add(row.parent)
+def _dry_run_report(result, limit=200):
+    """產生 dry-run 差異報告（最多列出 limit 筆）。"""
+    return [
+        {"po_item": row.name, "po": row.parent, "current": row.order_status}
+        for row in result["items"][:limit]
+    ]
 
-    logger.info(
-        f"[FIX] 其中有 {len(to_reset)} 筆 PO Item 的 Shipped 狀態是多餘的，"
-        f"將被重設為 '{reset_status_to}'，影響 {len(affected_po_names)} 張 PO"
-    )
+
+@frappe.whitelist()
+def fix_po_item_order_status_for_shipped_to(dry_run=False, reset_status_to=""):
+    """
+    清理錯誤標記為 Shipped 的 Purchase Order Item.order_status。
+    只保留「在 workflow_state = 'Shipped' 的 Transport Order Line 上」那些 PO Item 為 Shipped。
+    
+    :param dry_run: True = 只列出會被更新的資料，不真的寫入 DB
+    :param reset_status_to: 要改回的值，例如 "" 或 "Pending"
+    """
+    frappe.only_for("System Manager")
+    dry_run = frappe.utils.sbool(dry_run)
+    result = _reset_stale_shipped_status(dry_run, reset_status_to)
 
     if dry_run:
-        # 只列出前 200 筆預覽
-        for r in to_reset[:200]:
-            logger.info(f"[DRY RUN] 將重設 PO Item: {r.name} (PO: {r.parent})")
         return {
             "dry_run": True,
-            "to_reset_count": len(to_reset),
-            "affected_po_count": len(affected_po_names),
+            "to_reset_count": len(result["items"]),
+            "affected_po_count": len(result["affected_pos"]),
+            "diff": _dry_run_report(result),
         }
 
-    # -------------------------------
-    # D. 實際更新這些錯誤的 PO Item.order_status
-    # -------------------------------
-    for r in to_reset:
-        frappe.db.set_value(
-            "Purchase Order Item",
-            r.name,
-            "order_status",
-            reset_status_to
-        )
+    return {
+        "dry_run": False,
+        "reset_to": reset_status_to,
+        "affected_rows": result["reset_count"]
+    }
 
-    logger.info(f"[FIX] 已重設 {len(to_reset)} 筆 PO Item.order_status 為 '{reset_status_to}'")
 
-    # -------------------------------
-    # E. 逐張觸發對應 PO 的 before_save
-    #    方式與你 TO before_save 裡的一樣，用 flag 防無限 loop
-    # -------------------------------
-    for po_name in affected_po_names:
-        try:
-            po_doc = frappe.get_doc("Purchase Order", po_name)
-            if not frappe.flags.get("in_to_sync"):
-                frappe.flags.in_to_sync = True
-                po_doc.save()   # ⬅ 這裡會觸發 Purchase Order.before_save
-                frappe.flags.in_to_sync = False
-            logger.info(f"[FIX] 已觸發 PO {po_name} 的 before_save")
-        except Exception as e:
-            logger.error(f"[FIX] 觸發 PO {po_name} before_save 失敗: {str(e)}")
-            frappe.log_error(
-                f"Failed to trigger before_save for PO {po_name}: {str(e)}",
-                "TO → PO Fix Script"
-            )
+@frappe.whitelist()
+def fix_po_item_order_status_and_trigger_before_save(dry_run=True, reset_status_to=""):
+    """
+    1) 找出所有 order_status = 'Shipped' 的 Purchase Order Item
+    2) 只保留「有在 workflow_state = 'Shipped' 的 Transport Order Line 上」那幾筆
+    3) 其他多餘的改回 reset_status_to（查詢一次，再依主鍵每 FIX_CHUNK_SIZE 筆 UPDATE 並 commit）
+    4) 受影響的 Purchase Order 排入背景重新儲存，觸發 before_save 重新匯出
+    """
+    frappe.only_for("System Manager")
+    dry_run = frappe.utils.sbool(dry_run)
+    result = _reset_stale_shipped_status(dry_run, reset_status_to, log_prefix="[FIX] ")
 
-    frappe.db.commit()
-    logger.info(
-        f"[FIX] 完成修正，共重設 {len(to_reset)} 筆 PO Item，"
-        f"觸發 {len(affected_po_names)} 張 PO 的 before_save"
-    )
+    if dry_run:
+        return {
+            "dry_run": True,
+            "to_reset_count": len(result["items"]),
+            "affected_po_count": len(result["affected_pos"]),
+            "diff": _dry_run_report(result),
+        }
+
+    enqueue_po_export(sorted(result["affected_pos"]))
 
     return {
         "dry_run": False,
         "reset_to": reset_status_to,
-        "reset_item_count": len(to_reset),
-        "triggered_po_count": len(affected_po_names),
+        "reset_item_count": result["reset_count"],
+        "triggered_po_count": len(result["affected_pos"]),
     }
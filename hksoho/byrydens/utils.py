@@ -4,10 +4,14 @@ import mimetypes
 
 from frappe import _
 
-from frappe.utils.data import now_datetime, get_system_timezone, format_date, format_time  # 修正匯入為 get_system_timezone
+from frappe.utils.data import now_datetime, get_system_timezone, format_date, format_time, add_days, getdate  # 修正匯入為 get_system_timezone
 from datetime import date
 import pytz
 
+from hksoho.utils.trace import get_tracer
+
+tracer = get_tracer("inspection_reminder")
+
 def get_image_datauri(file_url):
     if not file_url:
         return ""
@@ -44,150 +48,187 @@ def get_image_datauri(file_url):
 
 
 
+# Reminder Log 連結 User 的欄位
+REMINDER_LOG_USER_FIELD = "link_nmjr"
+# 事件查詢範圍（前後天數）：涵蓋所有時區的「當地今天」
+REMINDER_WINDOW_DAYS = 1
+# 當地幾點發送提醒
+REMINDER_HOUR = 8
+INSPECTION_EVENT_EMAIL_FIELDS = [
+    "name", "inspector", "supplier", "type", "inspection",
+    "starts_on", "ends_on", "status", "description"
+]
+
+
 def send_daily_inspection_reminders():
     """
-    每小時執行：根據 Inspector 時區發送早上 8 點提醒
-    TEST MODE: Print sent emails to console
+    每小時執行：根據 Inspector 時區，在當地早上 8 點寄出當天事件的彙整提醒（每位 Inspector 一封）。
+    事件、Inspector 的 email / 時區、Reminder Log 各一次查詢；
+    沒有 Inspector 正值當地 8 點時，不會查詢 Reminder Log 或事件明細。
     """
-    now_utc = now_datetime()  # 取得 UTC 時間
-    print(f"\n=== Inspection Reminder Job Started at {frappe.utils.now()} (UTC) ===")
+    now_utc = now_datetime()
+    tracer.info("Inspection Reminder Job Started at %s", frappe.utils.now())
 
-    # 找出所有 Open 事件（不限今天，以防時區差異）
+    # 1. 事件：只取前後一天內的 Open 事件（涵蓋所有時區的「今天」）
     events = frappe.get_all(
         "Inspection Event",
         filters={
             "status": "Open",
             "send_reminder": 1,
-            "inspector": [">", ""]
+            "inspector": [">", ""],
+            "starts_on": ["between", [
+                add_days(now_utc, -REMINDER_WINDOW_DAYS - 1),
+                add_days(now_utc, REMINDER_WINDOW_DAYS + 1)
+            ]]
         },
-        fields=["name", "inspector", "starts_on"]
+        fields=INSPECTION_EVENT_EMAIL_FIELDS,
+        order_by="starts_on asc"
     )
-
     if not events:
-        print("No open events found. Job completed.\n")
+        tracer.info("No open events found. Job completed.")
         return
 
-    sent_count = 0
+    # 2. Inspector 的 email 與時區
+    users = {
+        u.name: u for u in frappe.get_all(
+            "User",
+            filters={"name": ["in", list({e.inspector for e in events})]},
+            fields=["name", "email", "time_zone"]
+        )
+    }
+
+    system_tz = get_system_timezone()
+    digests = {}
     for event in events:
-        try:
-            doc = frappe.get_doc("Inspection Event", event.name)
-            inspector_email = frappe.db.get_value("User", doc.inspector, "email")
-            if not inspector_email:
-                print(f"SKIP: Inspector '{doc.inspector}' has no email → Event: {doc.name}")
-                continue
+        user = users.get(event.inspector)
+        if not user or not user.email:
+            tracer.debug("SKIP: Inspector '%s' has no email → Event: %s", event.inspector, event.name)
+            continue
 
-            # 取得 Inspector 的時區
-            user_tz = frappe.db.get_value("User", doc.inspector, "time_zone") or get_system_timezone()  # 修正為 get_system_timezone
-            tz = pytz.timezone(user_tz)
-            now_local = now_utc.astimezone(tz)  # 轉換為當地時間
-            today_local = now_local.date()  # 當地今日日期
+        tz = pytz.timezone(user.time_zone or system_tz)
+        now_local = now_utc.astimezone(tz)
+        if now_local.hour != REMINDER_HOUR:
+            continue
 
-            # 檢查事件 starts_on 是否為當地今天（基於時區調整）
-            starts_on_local = frappe.utils.get_datetime(doc.starts_on).astimezone(tz).date()
-            if starts_on_local != today_local:
-                print(f"SKIP: Event {doc.name} not today in {user_tz} (starts_on: {starts_on_local})")
-                continue
+        # 檢查事件 starts_on 是否為當地今天（基於時區調整）
+        today_local = now_local.date()
+        starts_on_local = frappe.utils.get_datetime(event.starts_on).astimezone(tz).date()
+        if starts_on_local != today_local:
+            continue
+
+        digest = digests.setdefault(event.inspector, {"email": user.email, "today": today_local, "events": []})
+        digest["events"].append(event)
+
+    if not digests:
+        tracer.info("No inspector due for a reminder this hour. Job completed.")
+        return
+
+    # 3. Reminder Log：今天已寄過的 Inspector 略過
+    logs = {
+        log[REMINDER_LOG_USER_FIELD]: log for log in frappe.get_all(
+            "Reminder Log",
+            filters={REMINDER_LOG_USER_FIELD: ["in", list(digests)]},
+            fields=["name", REMINDER_LOG_USER_FIELD, "last_sent_date"]
+        )
+    }
+    digests = {
+        inspector: digest for inspector, digest in digests.items()
+        if not (logs.get(inspector) and logs[inspector].last_sent_date
+                and getdate(logs[inspector].last_sent_date) >= digest["today"])
+    }
+    if not digests:
+        tracer.info("All due reminders already sent today. Job completed.")
+        return
+
+    # 只有真的要寄時才載入事件明細與供應商名稱（各一次查詢）
+    events_to_load = [event for digest in digests.values() for event in digest["events"]]
+    load_event_lines(events_to_load)
+    partner_names = get_partner_names(event.supplier for event in events_to_load)
 
-            # 檢查最後發送記錄
-            log_name = frappe.db.get_value("Reminder Log", {"user": doc.inspector})
-            last_sent = None
-            if log_name:
-                last_sent = frappe.db.get_value("Reminder Log", log_name, "last_sent_date")
+    sent_count = 0
+    for inspector, digest in digests.items():
+        try:
+            events_to_send = digest["events"]
+            if len(events_to_send) == 1:
+                subject = f"Inspection Event Reminder: {events_to_send[0].name} - {format_date(events_to_send[0].starts_on)}"
+            else:
+                subject = f"Inspection Event Reminder: {len(events_to_send)} events - {format_date(digest['today'])}"
+
+            frappe.sendmail(
+                recipients=[digest["email"]],
+                subject=subject,
+                content="".join(
+                    get_email_html(event, partner_names.get(event.supplier) if event.supplier else "N/A")
+                    for event in events_to_send
+                ),
+                delayed=False
+            )
+            sent_count += 1
+            tracer.info("Reminder sent to %s for %s event(s): %s",
+                        digest["email"], len(events_to_send), [e.name for e in events_to_send])
+
+            # 更新最後發送日期
+            log = logs.get(inspector)
+            if log:
+                frappe.db.set_value("Reminder Log", log.name, "last_sent_date", digest["today"])
             else:
-                # 如果無記錄，建立新的一筆
-                new_log = frappe.get_doc({
+                frappe.get_doc({
                     "doctype": "Reminder Log",
-                    "user": doc.inspector,
-                    "last_sent_date": None
+                    REMINDER_LOG_USER_FIELD: inspector,
+                    "last_sent_date": digest["today"]
                 }).insert(ignore_permissions=True)
-                log_name = new_log.name
-
-            # 如果是當地早上 8 點，且今天尚未發送
-            if now_local.hour == 8 and (not last_sent or last_sent < today_local):
-                # === 測試用：印出即將寄送的資訊 ===
-                print(f"SENDING REMINDER →")
-                print(f"   Event     : {doc.name}")
-                print(f"   Inspector : {doc.inspector}")
-                print(f"   Email     : {inspector_email}")
-                print(f"   Starts On : {doc.starts_on} (Local: {now_local})")
-                print("-" * 50)
-
-                # 實際寄信
-                subject = f"Inspection Event Reminder: {doc.name} - {format_date(doc.starts_on)}"
-                html_body = get_email_html(doc)
-
-                frappe.sendmail(
-                    recipients=[inspector_email],
-                    subject=subject,
-                    content=html_body,
-                    delayed=False
-                )
-
-                sent_count += 1
-                print(f"SUCCESS: Email sent to {inspector_email}\n")
-
-                # 更新最後發送日期
-                frappe.db.set_value("Reminder Log", log_name, "last_sent_date", today_local)
 
         except Exception as e:
-            error_msg = str(e)
-            print(f"FAILED: {doc.name} → {error_msg}\n")
-            frappe.log_error(f"Inspection reminder failed for {doc.name}: {error_msg}")
+            frappe.log_error(f"Inspection reminder failed for {inspector}: {str(e)}")
 
-    print(f"=== Job Completed: {sent_count} reminder(s) sent ===\n")
+    tracer.info("Job Completed: %s reminder(s) sent", sent_count)
 
 
-def get_email_html(doc):
-    """Generate HTML email for Inspection Event (Confirmed QTY 已移除)"""
-    po_items = doc.get("po_items") or []
-    
-    # === 安全欄位映射（防呆，支援不同專案的欄位名稱）===
-    child_meta = frappe.get_meta("Inspection Line")
-    field_map = {
-        "line": next((f for f in child_meta.fields if f.fieldname in ["line", "idx", "po_line"]), None),
-        "article_number": next((f for f in child_meta.fields if f.fieldname in ["article_number", "item_code", "article_no"]), None),
-        "article_name": next((f for f in child_meta.fields if f.fieldname in ["article_name", "item_name"]), None),
-        "confirmed_qty": next((f for f in child_meta.fields if f.fieldname in ["confirmed_qty", "qty", "po_qty"]), None),
-        # confirmed_qty 已徹底移除
-    }
+def load_event_lines(events):
+    """一次查詢所有事件的 Inspection Line，放入各事件的 po_items"""
+    lines_by_event = {event.name: [] for event in events}
+    for event in events:
+        event.po_items = lines_by_event[event.name]
+    if not lines_by_event:
+        return
 
-    rows = ""
-    for item in po_items:
-        line = getattr(item, field_map["line"].fieldname, "") if field_map["line"] else ""
-        article_number = getattr(item, field_map["article_number"].fieldname, "") if field_map["article_number"] else ""
-        article_name = getattr(item, field_map["article_name"].fieldname, "") if field_map["article_name"] else ""
-        req_qty = getattr(item, field_map["confirmed_qty"].fieldname, 0) if field_map["confirmed_qty"] else 0
+    for line in frappe.get_all(
+        "Inspection Line",
+        filters={"parenttype": "Inspection Event", "parent": ["in", list(lines_by_event)]},
+        fields=["*"],
+        order_by="idx asc"
+    ):
+        lines_by_event[line.parent].append(line)
 
-        rows += f"""
-        <tr style="border-bottom: 1px solid #eee;">
-            <td style="padding: 8px;">{line}</td>
-            <td style="padding: 8px;">{article_number}</td>
-            <td style="padding: 8px;">{article_name}</td>
-            <td style="padding: 8px; text-align: right;">{req_qty}</td>
-        </tr>
-        """
 
-    if not rows:
-        rows = '<tr><td colspan="4" style="text-align:center; color:#999; padding:20px;">No PO Items</td></tr>'
+# 安全欄位映射（防呆，支援不同專案的欄位名稱）：依序取第一個存在的欄位
+EMAIL_FIELD_CANDIDATES = {
+    "line": ["line", "idx", "po_line"],
+    "article_number": ["article_number", "item_code", "article_no"],
+    "article_name": ["article_name", "item_name"],
+    "confirmed_qty": ["confirmed_qty", "qty", "po_qty"],
+}
 
-    supplier_name = frappe.db.get_value("Partner", doc.supplier, "partner_name") if doc.supplier else "N/A"
+# {doctype: (meta.modified, field_map)}，meta 變更後自動重新計算
+_email_field_maps = {}
+_email_template = None
 
-    return f"""
+EMAIL_TEMPLATE = """
     <div style="font-family: Arial, sans-serif; max-width: 700px; margin: auto; border: 1px solid #ddd; border-radius: 8px; overflow: hidden; box-shadow: 0 4px 12px rgba(0,0,0,0.1);">
         <div style="background: #1a5fb4; color: white; padding: 16px; text-align: center;">
             <h2 style="margin:0;">Inspection Event Reminder</h2>
         </div>
         <div style="padding: 20px; background: #f9f9f9;">
-            <h3 style="color: #1a5fb4; margin-top:0; border-bottom: 2px solid #1a5fb4; padding-bottom: 8px;">{doc.name}</h3>
+            <h3 style="color: #1a5fb4; margin-top:0; border-bottom: 2px solid #1a5fb4; padding-bottom: 8px;">{{ doc.name }}</h3>
             
             <table style="width:100%; margin:16px 0; font-size:14px;">
-                <tr><td style="font-weight:bold; width:140px;">Inspector:</td><td>{doc.inspector or 'N/A'}</td></tr>
-                <tr><td style="font-weight:bold;">Supplier:</td><td>{supplier_name}</td></tr>
-                <tr><td style="font-weight:bold;">Type:</td><td>{doc.type or ''}</td></tr>
-                <tr><td style="font-weight:bold;">Inspection:</td><td>{doc.inspection or ''}</td></tr>
-                <tr><td style="font-weight:bold;">Starts On:</td><td>{format_date(doc.starts_on)} {format_time(doc.starts_on)}</td></tr>
-                <tr><td style="font-weight:bold;">Ends On:</td><td>{doc.ends_on and (format_date(doc.ends_on) + ' ' + format_time(doc.ends_on)) or 'N/A'}</td></tr>
-                <tr><td style="font-weight:bold;">Status:</td><td><span style="background:#28a745; color:white; padding:2px 8px; border-radius:4px; font-size:12px;">{doc.status or ''}</span></td></tr>
+                <tr><td style="font-weight:bold; width:140px;">Inspector:</td><td>{{ doc.inspector or 'N/A' }}</td></tr>
+                <tr><td style="font-weight:bold;">Supplier:</td><td>{{ supplier_name }}</td></tr>
+                <tr><td style="font-weight:bold;">Type:</td><td>{{ doc.type or '' }}</td></tr>
+                <tr><td style="font-weight:bold;">Inspection:</td><td>{{ doc.inspection or '' }}</td></tr>
+                <tr><td style="font-weight:bold;">Starts On:</td><td>{{ starts_on }}</td></tr>
+                <tr><td style="font-weight:bold;">Ends On:</td><td>{{ ends_on }}</td></tr>
+                <tr><td style="font-weight:bold;">Status:</td><td><span style="background:#28a745; color:white; padding:2px 8px; border-radius:4px; font-size:12px;">{{ doc.status or '' }}</span></td></tr>
             </table>
 
             <h4 style="color:#1a5fb4; margin:24px 0 12px;">PO Items</h4>
@@ -201,11 +242,20 @@ def get_email_html(doc):
                     </tr>
                 </thead>
                 <tbody>
-                    {rows}
+                    {%- for row in rows %}
+                    <tr style="border-bottom: 1px solid #eee;">
+                        <td style="padding: 8px;">{{ row.line }}</td>
+                        <td style="padding: 8px;">{{ row.article_number }}</td>
+                        <td style="padding: 8px;">{{ row.article_name }}</td>
+                        <td style="padding: 8px; text-align: right;">{{ row.confirmed_qty }}</td>
+                    </tr>
+                    {%- else %}
+                    <tr><td colspan="4" style="text-align:center; color:#999; padding:20px;">No PO Items</td></tr>
+                    {%- endfor %}
                 </tbody>
             </table>
 
-            {f'<h4 style="color:#1a5fb4; margin:24px 0 12px;">Description</h4><div style="background:#fff; padding:12px; border-left:4px solid #1a5fb4; border-radius:4px; box-shadow: 0 1px 3px rgba(0,0,0,0.1); font-size:13px;">{doc.description}</div>' if doc.description else ''}
+            {% if doc.description %}<h4 style="color:#1a5fb4; margin:24px 0 12px;">Description</h4><div style="background:#fff; padding:12px; border-left:4px solid #1a5fb4; border-radius:4px; box-shadow: 0 1px 3px rgba(0,0,0,0.1); font-size:13px;">{{ doc.description | safe }}</div>{% endif %}
 
             <hr style="margin:24px 0; border:none; border-top:1px dashed #ccc;">
             <p style="font-size:12px; color:#666; text-align:center;">
@@ -215,6 +265,68 @@ def get_email_html(doc):
     </div>
     """
 
+
+def get_email_field_map(doctype="Inspection Line"):
+    """回傳 {key: fieldname or None}，每個 doctype 只在 meta 變更時重新計算"""
+    meta = frappe.get_meta(doctype)
+    cached = _email_field_maps.get(doctype)
+    if cached and cached[0] == meta.modified:
+        return cached[1]
+
+    fieldnames = {f.fieldname for f in meta.fields}
+    field_map = {
+        key: next((f for f in candidates if f in fieldnames), None)
+        for key, candidates in EMAIL_FIELD_CANDIDATES.items()
+    }
+    _email_field_maps[doctype] = (meta.modified, field_map)
+    return field_map
+
+
+def get_email_template():
+    """Inspection Event 提醒信的 Jinja template（只編譯一次）"""
+    global _email_template
+    if _email_template is None:
+        _email_template = frappe.get_jenv().from_string(EMAIL_TEMPLATE)
+    return _email_template
+
+
+def get_partner_names(suppliers):
+    """一次查詢多個 Partner 的 partner_name：{name: partner_name}"""
+    suppliers = list({s for s in suppliers if s})
+    if not suppliers:
+        return {}
+    return dict(frappe.get_all(
+        "Partner",
+        filters={"name": ["in", suppliers]},
+        fields=["name", "partner_name"],
+        as_list=True
+    ))
+
+
+def get_email_html(doc, supplier_name=None):
+    """Generate HTML email for Inspection Event (Confirmed QTY 已移除)"""
+    field_map = get_email_field_map()
+
+    rows = []
+    for item in doc.get("po_items") or []:
+        rows.append({
+            "line": getattr(item, field_map["line"], "") if field_map["line"] else "",
+            "article_number": getattr(item, field_map["article_number"], "") if field_map["article_number"] else "",
+            "article_name": getattr(item, field_map["article_name"], "") if field_map["article_name"] else "",
+            "confirmed_qty": getattr(item, field_map["confirmed_qty"], 0) if field_map["confirmed_qty"] else 0,
+        })
+
+    if supplier_name is None:
+        supplier_name = frappe.get_cached_value("Partner", doc.supplier, "partner_name") if doc.supplier else "N/A"
+
+    return get_email_template().render(
+        doc=doc,
+        rows=rows,
+        supplier_name=supplier_name,
+        starts_on=f"{format_date(doc.starts_on)} {format_time(doc.starts_on)}",
+        ends_on=doc.ends_on and (format_date(doc.ends_on) + " " + format_time(doc.ends_on)) or "N/A",
+    )
+
 @frappe.whitelist()
 def load_product_images_to_po_items(po_name):
     """
@@ -395,8 +507,10 @@ import frappe
 from frappe.utils import get_last_day
 from frappe import _
 
+from hksoho.byrydens.orders_due_api import BASE_CURRENCY, RATE_BASIS_SHIP_DATE, get_due_pos
+
 @frappe.whitelist()
-def get_due_po_details(year, month_name):
+def get_due_po_details(year, month_name, rate_basis=RATE_BASIS_SHIP_DATE):
     month_map = {
         "January": "01", "February": "02", "March": "03", "April": "04",
         "May": "05", "June": "06", "July": "07", "August": "08",
@@ -407,28 +521,7 @@ def get_due_po_details(year, month_name):
     if not month:
         return {"title": "錯誤", "data": [], "columns": [], "message": "月份格式錯誤"}
 
-    start = f"{year}-{month}-01"
-    end = get_last_day(start)
-
-    data = frappe.db.sql("""
-        SELECT 
-            po.name AS po_number,
-            po.supplier AS partner_id,
-            COALESCE(p.partner_name, po.supplier, 'Unknown') AS partner_name,
-            po.po_shipdate,
-            po.po_status,
-            po.order_purchase_currency AS currency,
-            SUM((item.confirmed_qty - COALESCE(item.booked_qty, 0)) * item.unit_price) AS undelivered_value
-        FROM `tabPurchase Order` po
-        LEFT JOIN `tabPartner` p ON p.partner_id = po.supplier
-        JOIN `tabPurchase Order Item` item ON item.parent = po.name
-        WHERE po.po_shipdate BETWEEN %s AND %s
-          AND item.confirmed_qty > COALESCE(item.booked_qty, 0)
-          AND item.unit_price > 0
-        GROUP BY po.name
-        HAVING undelivered_value > 0
-        ORDER BY po.po_shipdate DESC, po.name DESC
-    """, (start, end), as_dict=1)
+    data = get_due_pos(int(year), int(month), rate_basis)
 
     columns = [
         {"label": "PO Number", "fieldname": "po_number", "fieldtype": "Link", "options": "Purchase Order", "width": 140},
@@ -438,10 +531,14 @@ def get_due_po_details(year, month_name):
         {"label": "Status", "fieldname": "po_status", "fieldtype": "Data", "width": 100},
         {"label": "Currency", "fieldname": "currency", "fieldtype": "Data", "width": 80},
         {"label": "Undelivered Value", "fieldname": "undelivered_value", "fieldtype": "Currency", "width": 160},
+        {"label": "Rate to SEK", "fieldname": "sek_rate", "fieldtype": "Float", "width": 100},
+        {"label": "Undelivered Value (SEK)", "fieldname": "undelivered_value_sek", "fieldtype": "Currency", "width": 160},
     ]
 
     return {
         "title": f"{month_name} {year} – Orders Due to Pay ({len(data)} POs)",
         "columns": columns,
-        "data": data
+        "data": data,
+        "base_currency": BASE_CURRENCY,
+        "rate_basis": rate_basis,
     }
\ No newline at end of file
@@ -0,0 +1,7 @@
+from hksoho.byrydens.inspection_stats import rebuild_inspection_stats_job
+
+
+def execute():
+    # 統計表只靠之後的增量更新不會有歷史資料，migrate 後兩個來源都全量回填一次
+    for source in ("xpin", "Inspection"):
+        rebuild_inspection_stats_job(source)
@@ -0,0 +1,6 @@
+from hksoho.byrydens.orders_due_api import rebuild_po_due_summary_job
+
+
+def execute():
+    # Orders Due to Pay 只讀 PO Due Summary，migrate 後須先回填，否則報表為空
+    rebuild_po_due_summary_job()
@@ -0,0 +1,16 @@
+frappe.provide("hksoho");
+
+// 報表背景匯出按鈕（逐列寫檔，完成後通知），帶入畫面上目前的篩選條件
+hksoho.add_background_export_buttons = function(report) {
+	["CSV", "Excel"].forEach(function(file_format) {
+		report.page.add_inner_button(__(file_format), function() {
+			frappe.call({
+				method: "hksoho.byrydens.report_export.export_report",
+				args: { report_name: report.report_name, file_format: file_format, filters: report.get_filter_values() },
+				callback: function() {
+					frappe.show_alert({ message: __("Export queued, you will be notified when it is ready"), indicator: "green" });
+				}
+			});
+		}, __("Background Export"));
+	});
+};
@@ -0,0 +1,118 @@
+"""
+hksoho 輕量追蹤（trace）工具
+
+排程工作與 API 的除錯訊息不要再寫 Error Log（每次都是一筆 INSERT），改用：
+
+    from hksoho.utils.trace import get_tracer
+    tracer = get_tracer("inspection_check")
+    tracer.debug("Processing Event %s", ev.name)
+
+- 寫入 site 的 logs/hksoho_trace.log（frappe.logger，自動 rotate）
+- 同時保留最近的訊息在記憶體 ring buffer（每個 worker process 各自一份）
+- 訊息使用 %s 參數，低於門檻或未被抽樣時不會組字串
+
+site_config.json 設定：
+    hksoho_trace_level        DEBUG / INFO / WARNING / ERROR（預設 WARNING）
+    hksoho_trace_sample_rate  DEBUG / INFO 訊息的抽樣比例 0 ~ 1（預設 1）
+    hksoho_trace_buffer_size  ring buffer 筆數（預設 500）
+
+frappe.log_error 只留給真正的錯誤。
+"""
+
+import logging
+import random
+from collections import deque
+
+import frappe
+from frappe.utils import cint, flt, now
+
+TRACE_LOG_NAME = "hksoho_trace"
+DEFAULT_TRACE_LEVEL = "WARNING"
+DEFAULT_BUFFER_SIZE = 500
+TRACE_FILE_MAX_SIZE = 5 * 1024 * 1024
+TRACE_FILE_COUNT = 5
+
+_buffer = deque(maxlen=DEFAULT_BUFFER_SIZE)
+_tracers = {}
+
+
+class Tracer:
+    def __init__(self, name):
+        self.name = name
+
+    def is_enabled_for(self, level):
+        return level >= _get_level()
+
+    def debug(self, message, *args):
+        self._trace(logging.DEBUG, message, args)
+
+    def info(self, message, *args):
+        self._trace(logging.INFO, message, args)
+
+    def warning(self, message, *args):
+        self._trace(logging.WARNING, message, args)
+
+    def error(self, message, *args):
+        self._trace(logging.ERROR, message, args)
+
+    def _trace(self, level, message, args):
+        if level < _get_level():
+            return
+        # WARNING 以上一律記錄，DEBUG / INFO 依抽樣比例
+        if level < logging.WARNING:
+            # bench set-config 可能存成字串，須轉為數字
+            sample_rate = flt(frappe.conf.get("hksoho_trace_sample_rate", 1))
+            if sample_rate < 1 and random.random() >= sample_rate:
+                return
+
+        text = message % args if args else message
+        _get_buffer().append((now(), logging.getLevelName(level), self.name, text))
+        try:
+            _get_logger().log(level, "[%s] %s", self.name, text)
+        except Exception:
+            # 追蹤失敗不可影響主流程
+            pass
+
+
+def get_tracer(name):
+    """取得指定模組的 Tracer（同名共用）"""
+    tracer = _tracers.get(name)
+    if tracer is None:
+        tracer = _tracers[name] = Tracer(name)
+    return tracer
+
+
+@frappe.whitelist()
+def get_recent_traces(limit=100, name=None):
+    """回傳目前 worker 記憶體中最近的追蹤訊息（新到舊）"""
+    frappe.only_for("System Manager")
+    limit = int(limit)
+    entries = [e for e in reversed(_get_buffer()) if not name or e[2] == name]
+    return [
+        {"time": t, "level": level, "name": n, "message": text}
+        for t, level, n, text in entries[:limit]
+    ]
+
+
+def _get_level():
+    level = frappe.conf.get("hksoho_trace_level") or DEFAULT_TRACE_LEVEL
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    return level if isinstance(level, int) else logging.WARNING
+
+
+def _get_buffer():
+    global _buffer
+    size = cint(frappe.conf.get("hksoho_trace_buffer_size")) or DEFAULT_BUFFER_SIZE
+    if _buffer.maxlen != size:
+        _buffer = deque(_buffer, maxlen=size)
+    return _buffer
+
+
+def _get_logger():
+    # frappe.logger 依 site 快取 logger，並使用 RotatingFileHandler
+    logger = frappe.logger(
+        TRACE_LOG_NAME, allow_site=True, max_size=TRACE_FILE_MAX_SIZE, file_count=TRACE_FILE_COUNT
+    )
+    logger.setLevel(logging.DEBUG)
+    return logger